@@ -0,0 +1,275 @@
+"""Бенчмарк бота на локальном фейковом Transmission RPC с 10k-100k торрентов
+
+Каждый размер библиотеки прогоняется в отдельном процессе (чистый пиковый RSS).
+Результат - JSON с перцентилями задержек, трафиком RPC и пиковым RSS по сценариям.
+
+Примеры:
+    python bench/bench.py --torrents 10000,100000 --output bench-results.json
+    python bench/bench.py --torrents 10000 --baseline bench-results.json
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import types
+from datetime import datetime, timezone
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BOT_DIR = os.path.join(os.path.dirname(BENCH_DIR), "bot")
+USER_ID = 1
+
+
+# Замены объектов Telegram: запоминают ответы вместо запросов к Bot API
+class FakeMessage:
+    def __init__(self, user_id: int = USER_ID):
+        self.from_user = types.SimpleNamespace(id=user_id)
+        self.chat = types.SimpleNamespace(id=user_id)
+        self.message_id = 1
+        self.text = ""
+
+    async def answer(self, text, **kwargs):
+        if text.startswith("❌"):
+            raise RuntimeError(f"Обработчик ответил ошибкой: {text}")
+        return FakeMessage(self.from_user.id)
+
+    async def edit_text(self, text, **kwargs):
+        self.text = text
+        return self
+
+
+class FakeCallback:
+    def __init__(self, data: str, user_id: int = USER_ID):
+        self.id = "bench"
+        self.data = data
+        self.from_user = types.SimpleNamespace(id=user_id)
+        self.message = FakeMessage(user_id)
+
+    async def answer(self, text=None, show_alert=False, **kwargs):
+        if show_alert:
+            raise RuntimeError(f"Обработчик ответил ошибкой: {text}")
+
+
+def percentile(sorted_values: list, q: float) -> float:
+    """Перцентиль по ближайшему рангу"""
+    index = min(len(sorted_values) - 1, max(0, math.ceil(q * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(samples: list, rpc_bytes: int, rpc_requests: int) -> dict:
+    samples = sorted(samples)
+    return {
+        "iterations": len(samples),
+        "p50_ms": round(percentile(samples, 0.50) * 1000, 3),
+        "p90_ms": round(percentile(samples, 0.90) * 1000, 3),
+        "p99_ms": round(percentile(samples, 0.99) * 1000, 3),
+        "max_ms": round(samples[-1] * 1000, 3),
+        "mean_ms": round(sum(samples) / len(samples) * 1000, 3),
+        "rpc_bytes_per_op": rpc_bytes // len(samples),
+        "rpc_requests_per_op": round(rpc_requests / len(samples), 2),
+    }
+
+
+async def measure(daemon, iterations: int, operation, setup=None) -> dict:
+    """Задержки operation(i); setup() перед каждой итерацией в замер не входит"""
+    samples = []
+    bytes_before, requests_before = daemon.bytes_out, daemon.requests
+    for i in range(iterations):
+        if setup is not None:
+            setup()
+        started = time.perf_counter()
+        await operation(i)
+        samples.append(time.perf_counter() - started)
+    return summarize(samples, daemon.bytes_out - bytes_before, daemon.requests - requests_before)
+
+
+async def run_scenarios(bot, daemon, iterations: int) -> dict:
+    from aiogram.fsm.context import FSMContext
+    from aiogram.fsm.storage.base import StorageKey
+
+    state = FSMContext(storage=bot.storage, key=StorageKey(bot_id=0, chat_id=USER_ID, user_id=USER_ID))
+    snapshot = bot.torrent_snapshot
+    await snapshot.refresh()
+    list_pages = max(1, len(snapshot.order) // bot.MAX_TORRENTS_DISPLAY)
+    delete_pages = max(1, len(snapshot.order) // 9)
+
+    async def list_page(i):
+        await bot.get_torrents_list_page(page=i * 7 % list_pages)
+
+    async def delete_keyboard(i):
+        await bot.get_torrents_keyboard(page=i * 7 % delete_pages)
+
+    async def status(i):
+        await bot.cmd_status(FakeMessage())
+
+    async def status_details(i):
+        await bot.get_status_message(breakdown=True)
+
+    async def delete_flow(i):
+        await bot.cmd_delete(FakeMessage(), state)
+        torrent_id = snapshot.get_sorted(0, 1)[0].id
+        await bot.handle_delete_select(FakeCallback(f"delete_select_{torrent_id}"), state)
+        await bot.handle_delete_confirm(FakeCallback(f"confirm_delete_no_files_{torrent_id}"), state)
+
+    monitor = bot.CompletionMonitor(bot.completion_store)
+
+    def force_full_sync():
+        monitor.last_full_sync = float("-inf")
+
+    async def monitor_poll(i):
+        await monitor.poll()
+
+    scenarios = {}
+    scenarios["list_page_cold"] = await measure(daemon, iterations, list_page, snapshot.invalidate)
+    scenarios["list_page_warm"] = await measure(daemon, iterations, list_page)
+    scenarios["delete_keyboard_cold"] = await measure(daemon, iterations, delete_keyboard, snapshot.invalidate)
+    scenarios["delete_keyboard_warm"] = await measure(daemon, iterations, delete_keyboard)
+    scenarios["status_cold"] = await measure(daemon, iterations, status, snapshot.invalidate)
+    scenarios["status_details_cold"] = await measure(daemon, iterations, status_details, snapshot.invalidate)
+    scenarios["delete_flow"] = await measure(daemon, iterations, delete_flow)
+    scenarios["monitor_full_sync"] = await measure(daemon, iterations, monitor_poll, force_full_sync)
+    scenarios["monitor_delta"] = await measure(daemon, iterations, monitor_poll)
+    return scenarios
+
+
+def run_worker(args) -> dict:
+    """Один размер библиотеки в текущем процессе"""
+    sys.path.insert(0, BENCH_DIR)
+    from fake_transmission import FakeTransmission, serve
+
+    started = time.perf_counter()
+    daemon = FakeTransmission(args.torrents, args.name_length, args.active_ratio)
+    server = serve(daemon)
+    generated_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    os.environ.update(
+        BOT_TOKEN="123456:BENCHMARKbenchmarkBENCHMARKbench",
+        ALLOWED_USER_IDS=str(USER_ID),
+        TRANSMISSION_HOST="127.0.0.1",
+        TRANSMISSION_PORT=str(server.server_port),
+        DATA_DIR=tempfile.mkdtemp(prefix="tmbot-bench-"),
+        SESSION_BACKEND="memory",
+    )
+    sys.path.insert(0, BOT_DIR)
+    import bot
+
+    scenarios = asyncio.run(run_scenarios(bot, daemon, args.iterations))
+    server.shutdown()
+    return {
+        "torrents": args.torrents,
+        "scenarios": scenarios,
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        # Часть RSS занимает сам фейковый демон, он живет в том же процессе
+        "fake_daemon_rss_kb": generated_rss_kb,
+        "wall_time_s": round(time.perf_counter() - started, 2),
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BENCH_DIR,
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def print_summary(result: dict) -> None:
+    print(f"\n{result['torrents']} торрентов, пиковый RSS {result['peak_rss_kb'] / 1024:.1f} MB", file=sys.stderr)
+    for name, stats in result["scenarios"].items():
+        print(
+            f"  {name:<22} p50 {stats['p50_ms']:>10.2f} ms  p99 {stats['p99_ms']:>10.2f} ms  "
+            f"RPC {stats['rpc_bytes_per_op'] / 1024:>10.1f} KB/op",
+            file=sys.stderr
+        )
+
+
+def print_comparison(baseline: dict, report: dict) -> None:
+    """Изменение p50 относительно предыдущего отчета"""
+    previous = {result["torrents"]: result["scenarios"] for result in baseline["results"]}
+    print(f"\nСравнение с {baseline.get('git_commit') or 'baseline'} (p50):", file=sys.stderr)
+    for result in report["results"]:
+        old_scenarios = previous.get(result["torrents"], {})
+        for name, stats in result["scenarios"].items():
+            old = old_scenarios.get(name)
+            if old is None or not old["p50_ms"]:
+                continue
+            ratio = stats["p50_ms"] / old["p50_ms"]
+            print(
+                f"  {result['torrents']:>7} {name:<22} {old['p50_ms']:>10.2f} -> {stats['p50_ms']:>10.2f} ms  x{ratio:.2f}",
+                file=sys.stderr
+            )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Бенчмарк Transmission Master Bot на фейковом RPC")
+    parser.add_argument("--torrents", default="10000,100000", help="размеры библиотеки через запятую")
+    parser.add_argument("--iterations", type=int, default=20, help="итераций на сценарий")
+    parser.add_argument("--name-length", type=int, default=60, help="длина имени торрента")
+    parser.add_argument("--active-ratio", type=float, default=0.01, help="доля торрентов в ответе recently-active")
+    parser.add_argument("--output", help="файл для JSON-отчета (по умолчанию stdout)")
+    parser.add_argument("--baseline", help="предыдущий JSON-отчет для сравнения")
+    parser.add_argument("--worker-output", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    if args.worker_output:
+        args.torrents = int(args.torrents)
+        with open(args.worker_output, "w") as f:
+            json.dump(run_worker(args), f)
+        return
+
+    results = []
+    for count in (int(value) for value in args.torrents.split(",") if value.strip()):
+        with tempfile.NamedTemporaryFile(suffix=".json") as worker_output:
+            subprocess.run(
+                [
+                    sys.executable, os.path.abspath(__file__),
+                    "--torrents", str(count),
+                    "--iterations", str(args.iterations),
+                    "--name-length", str(args.name_length),
+                    "--active-ratio", str(args.active_ratio),
+                    "--worker-output", worker_output.name,
+                ],
+                check=True,
+                stdout=subprocess.DEVNULL
+            )
+            result = json.load(worker_output)
+        print_summary(result)
+        results.append(result)
+
+    report = {
+        "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "parameters": {
+            "iterations": args.iterations,
+            "name_length": args.name_length,
+            "active_ratio": args.active_ratio,
+        },
+        "results": results,
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    else:
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            print_comparison(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
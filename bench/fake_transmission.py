@@ -0,0 +1,130 @@
+"""Локальная замена Transmission RPC для бенчмарков: N сгенерированных торрентов в памяти"""
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SESSION_ID = "bench-session"
+
+# Коды статусов Transmission: 0 - остановлен, 4 - загружается, 6 - раздается
+STATUSES = [0, 4, 6, 6, 6]
+
+
+class FakeTransmission:
+    """Состояние фейкового демона: торренты, удаленные ID и объем отданных ответов"""
+
+    def __init__(self, torrent_count: int, name_length: int = 60, active_ratio: float = 0.01, seed: int = 1):
+        self.lock = threading.Lock()
+        self.random = random.Random(seed)
+        self.name_length = name_length
+        self.active_ratio = active_ratio
+        self.torrents = {}
+        self.removed = []
+        self.next_id = 1
+        self.bytes_out = 0
+        self.requests = 0
+        for _ in range(torrent_count):
+            self.add()
+
+    def add(self) -> dict:
+        torrent_id = self.next_id
+        self.next_id += 1
+        status = self.random.choice(STATUSES)
+        name = f"Torrent.{torrent_id}." + "x" * max(0, self.name_length - len(str(torrent_id)) - 9)
+        now = int(time.time())
+        self.torrents[torrent_id] = {
+            "id": torrent_id,
+            "hashString": hashlib.sha1(str(torrent_id).encode()).hexdigest(),
+            "name": name[:self.name_length],
+            "status": status,
+            "percentDone": 1.0 if status == 6 else round(self.random.random(), 4),
+            "totalSize": self.random.randint(10 ** 6, 10 ** 11),
+            "error": 0 if torrent_id % 50 else 2,
+            "errorString": "" if torrent_id % 50 else "Tracker gave HTTP response code 404",
+            "rateDownload": 100000 if status == 4 else 0,
+            "rateUpload": 50000 if status == 6 else 0,
+            "eta": 600 if status == 4 else -1,
+            "addedDate": now - torrent_id * 60,
+            "doneDate": now - torrent_id * 30 if status == 6 else 0,
+            "downloadDir": "/downloads/complete/Other",
+        }
+        return self.torrents[torrent_id]
+
+    def handle(self, method: str, arguments: dict) -> dict:
+        ids = arguments.get("ids")
+        if isinstance(ids, int):
+            ids = [ids]
+
+        with self.lock:
+            if method == "session-get":
+                return {"version": "4.0.6 (bench)", "rpc-version": 17, "rpc-version-semver": "5.3.0",
+                        "download-dir": "/downloads/complete"}
+
+            if method == "session-stats":
+                torrents = self.torrents.values()
+                return {
+                    "activeTorrentCount": sum(1 for t in torrents if t["status"] != 0),
+                    "pausedTorrentCount": sum(1 for t in torrents if t["status"] == 0),
+                    "torrentCount": len(self.torrents),
+                    "downloadSpeed": sum(t["rateDownload"] for t in torrents),
+                    "uploadSpeed": sum(t["rateUpload"] for t in torrents),
+                }
+
+            if method == "torrent-get":
+                result = {}
+                if ids == "recently-active":
+                    count = int(len(self.torrents) * self.active_ratio)
+                    selected = self.random.sample(list(self.torrents.values()), count)
+                    result["removed"], self.removed = self.removed, []
+                elif ids:
+                    selected = [self.torrents[i] for i in ids if i in self.torrents]
+                else:
+                    selected = list(self.torrents.values())
+                fields = arguments["fields"]
+                result["torrents"] = [{field: t[field] for field in fields if field in t} for t in selected]
+                return result
+
+            if method == "torrent-remove":
+                for torrent_id in ids or []:
+                    if self.torrents.pop(torrent_id, None) is not None:
+                        self.removed.append(torrent_id)
+                return {}
+
+            if method == "free-space":
+                return {"path": arguments["path"], "size-bytes": 10 ** 12}
+
+        return {}
+
+
+def serve(daemon: FakeTransmission, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    """Запуск HTTP-сервера RPC в фоновом потоке; порт 0 - выбрать свободный"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            if self.headers.get("X-Transmission-Session-Id") != SESSION_ID:
+                self.send_response(409)
+                self.send_header("X-Transmission-Session-Id", SESSION_ID)
+                self.end_headers()
+                return
+
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            arguments = daemon.handle(body["method"], body.get("arguments", {}))
+            response = json.dumps({"result": "success", "arguments": arguments, "tag": body.get("tag")}).encode()
+            with daemon.lock:
+                daemon.bytes_out += len(response)
+                daemon.requests += 1
+
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(response)))
+            self.end_headers()
+            self.wfile.write(response)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
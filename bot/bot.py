@@ -1,12 +1,31 @@
 import asyncio
+import bisect
+import functools
+import io
 import os
-import tempfile
+import pickle
+import random
+import re
+import signal
+import sqlite3
+import sys
+import threading
+import time
+import zipfile
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
 from aiogram import Bot, Dispatcher, F
-from aiogram.filters import Command
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.filters import Command, CommandObject
 from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.types import InlineQuery, InlineQueryResultArticle, InputTextMessageContent
+from aiogram.fsm.storage.base import BaseStorage
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
 import transmission_rpc
 from dotenv import load_dotenv
 
@@ -17,6 +36,18 @@ load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 ALLOWED_USER_IDS = [int(id.strip()) for id in os.getenv("ALLOWED_USER_IDS", "").split(",") if id.strip()]
 
+# Режим получения обновлений: polling (long polling) или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling").strip().lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+
+# HTTP-эндпоинт метрик Prometheus (/metrics); 0 - выключен
+METRICS_HOST = os.getenv("METRICS_HOST", "0.0.0.0")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
 # Конфигурация Transmission
 TRANSMISSION_HOST = os.getenv("TRANSMISSION_HOST", "transmission")
 TRANSMISSION_PORT = int(os.getenv("TRANSMISSION_PORT", "9091"))
@@ -24,9 +55,56 @@ TRANSMISSION_USER = os.getenv("TRANSMISSION_USER")
 TRANSMISSION_PASS = os.getenv("TRANSMISSION_PASS")
 
 # Конфигурация мониторинга
-CHECK_INTERVAL = int(os.getenv("CHECK_INTERVAL", "60"))
+CHECK_INTERVAL = int(os.getenv("CHECK_INTERVAL", "30"))
+# Адаптивный опрос: не чаще MIN_CHECK_INTERVAL при близком ETA, до MAX_CHECK_INTERVAL без загрузок
+MIN_CHECK_INTERVAL = int(os.getenv("MIN_CHECK_INTERVAL", "5"))
+MAX_CHECK_INTERVAL = int(os.getenv("MAX_CHECK_INTERVAL", "50"))
+
+# Живой прогресс: интервал опроса, пока есть отслеживаемые сообщения (сек), и их максимум
+TRACK_INTERVAL = int(os.getenv("TRACK_INTERVAL", "10"))
+TRACK_MAX_MESSAGES = int(os.getenv("TRACK_MAX_MESSAGES", "20"))
+FULL_SYNC_INTERVAL = int(os.getenv("FULL_SYNC_INTERVAL", "600"))
+
+# Transmission считает торрент "recently-active", если он менялся за последние 60 секунд.
+# Между опросами дольше этого окна инкрементальное обновление невозможно
+RECENTLY_ACTIVE_WINDOW = 60
+# Запас на длительность самого опроса: интервал без загрузок не выходит за окно минус запас
+RECENTLY_ACTIVE_MARGIN = 10
 MAX_TORRENTS_DISPLAY = int(os.getenv("MAX_TORRENTS_DISPLAY", "10"))
 
+# Время жизни общего снимка списка торрентов (в секундах)
+SNAPSHOT_TTL = float(os.getenv("SNAPSHOT_TTL", "15"))
+
+# Количество отрисованных страниц списков, которые держим в памяти
+RENDER_CACHE_SIZE = int(os.getenv("RENDER_CACHE_SIZE", "64"))
+
+# Конфигурация RPC: число параллельных запросов и таймаут одного вызова (сек)
+RPC_WORKERS = max(1, int(os.getenv("RPC_WORKERS", "4")))
+RPC_TIMEOUT = float(os.getenv("RPC_TIMEOUT", "30"))
+RPC_CONNECT_TIMEOUT = float(os.getenv("RPC_CONNECT_TIMEOUT", "5"))
+
+# Повторы читающих вызовов при сбое подключения и circuit breaker: после RPC_BREAKER_FAILURES
+# сбоев подряд запросы RPC_BREAKER_COOLDOWN секунд сразу завершаются ошибкой "Transmission недоступен"
+RPC_RETRIES = int(os.getenv("RPC_RETRIES", "2"))
+RPC_BREAKER_FAILURES = int(os.getenv("RPC_BREAKER_FAILURES", "5"))
+RPC_BREAKER_COOLDOWN = float(os.getenv("RPC_BREAKER_COOLDOWN", "30"))
+RPC_RETRY_BASE_DELAY = 0.5
+RPC_RETRY_MAX_DELAY = 5.0
+# Повторов не больше 20% от успешных вызовов (плюс запас на 10 повторов)
+RPC_RETRY_BUDGET_RATIO = 0.2
+RPC_RETRY_BUDGET_CAPACITY = 10
+
+# Лимиты отправки сообщений Telegram (сообщений в секунду): всего и в один чат
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "25"))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+TELEGRAM_SEND_ATTEMPTS = 3
+# Telegram ограничивает сообщение 4096 символами UTF-16, оставляем запас на emoji
+TELEGRAM_MESSAGE_LIMIT = 4000
+
+# Каталог для постоянных данных бота (SQLite)
+DATA_DIR = os.getenv("DATA_DIR", "data")
+STATE_DB_PATH = os.path.join(DATA_DIR, "bot_state.sqlite3")
+
 # Временная зона
 TIMEZONE = os.getenv("TZ", "Europe/Moscow")
 
@@ -37,38 +115,360 @@ EMOJI_PAUSED = os.getenv("EMOJI_PAUSED", "⏸️")
 EMOJI_ERROR = os.getenv("EMOJI_ERROR", "❌")
 EMOJI_COMPLETED = os.getenv("EMOJI_COMPLETED", "🎉")
 
+# Фильтр массового удаления: раздающиеся дольше стольких дней
+DELETE_SEED_DAYS = int(os.getenv("DELETE_SEED_DAYS", "30"))
+
+# Сессии пользователей (незавершенные диалоги): хранилище memory или sqlite, время жизни (сек) и лимит записей
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "sqlite").strip().lower()
+SESSION_TTL = int(os.getenv("SESSION_TTL", "3600"))
+SESSION_MAX_ENTRIES = int(os.getenv("SESSION_MAX_ENTRIES", "1000"))
+SESSION_PURGE_INTERVAL = 60
+
+# Загрузка .torrent файлов: максимальный размер (байт) и время ожидания выбора категории (сек)
+MAX_TORRENT_FILE_SIZE = int(os.getenv("MAX_TORRENT_FILE_SIZE", str(5 * 1024 * 1024)))
+PENDING_UPLOAD_TTL = int(os.getenv("PENDING_UPLOAD_TTL", "900"))
+
+# Массовое добавление: максимум торрентов за раз и одновременных добавлений
+BULK_MAX_ITEMS = int(os.getenv("BULK_MAX_ITEMS", "100"))
+BULK_ADD_CONCURRENCY = max(1, int(os.getenv("BULK_ADD_CONCURRENCY", "3")))
+# Bot API отдает боту файлы не больше 20 MB
+MAX_ARCHIVE_SIZE = 20 * 1024 * 1024
+# Сколько всего можно распаковать из одного архива (защита от zip-бомб)
+MAX_ARCHIVE_UNPACKED_SIZE = 50 * 1024 * 1024
+# Сколько ждать остальные файлы альбома (media group), прежде чем спросить категорию
+MEDIA_GROUP_DELAY = 1.5
+
+MAGNET_PATTERN = re.compile(r"magnet:\?\S+")
+
+# Поиск по именам: слова без "_" (разделитель в именах релизов), число результатов /find и inline
+NAME_TOKEN_PATTERN = re.compile(r"[^\W_]+")
+FIND_RESULTS_LIMIT = 10
+INLINE_RESULTS_LIMIT = 20
+
+# История скоростей: (имя, секунд в ячейке, число ячеек), период записи и сохранения (сек), ширина графика
+HISTORY_RESOLUTIONS = (("minute", 60, 60), ("hour", 3600, 48), ("day", 86400, 30))
+HISTORY_SAMPLE_INTERVAL = 30
+HISTORY_SAVE_INTERVAL = 300
+HISTORY_CHART_WIDTH = 30
+
+# Выбор файлов: строк дерева на странице и длина имени в кнопке
+FILES_PAGE_SIZE = 8
+FILE_NAME_MAX_LENGTH = 40
+
 # Категории для загрузки
 DOWNLOAD_CATEGORIES = os.getenv("DOWNLOAD_CATEGORIES", "Movies,Series,Music,Other").split(",")
 
+# Планировщик загрузок: лимиты одновременных загрузок по категориям ("Series:2,Other:1"),
+# общий лимит (0 - без ограничения) и порядок категорий от важной к менее важной
+CATEGORY_LIMITS = {
+    name.strip(): int(limit)
+    for name, _, limit in (item.partition(":") for item in os.getenv("CATEGORY_LIMITS", "").split(","))
+    if name.strip() and limit.strip()
+}
+MAX_ACTIVE_DOWNLOADS = int(os.getenv("MAX_ACTIVE_DOWNLOADS", "0"))
+CATEGORY_PRIORITY = [
+    category.strip() for category in (os.getenv("CATEGORY_PRIORITY") or ",".join(DOWNLOAD_CATEGORIES)).split(",")
+    if category.strip()
+]
+DOWNLOAD_SCHEDULER_ENABLED = bool(CATEGORY_LIMITS) or MAX_ACTIVE_DOWNLOADS > 0
+
+# Поля torrent-get для каждого представления: запрашиваем только то, что реально отображается
+LIST_FIELDS = ["id", "name", "status", "percentDone", "totalSize", "error", "errorString"]
+DELETE_LIST_FIELDS = ["id", "name", "status", "error", "errorString", "addedDate", "doneDate"]
+DELETE_DETAIL_FIELDS = ["id", "name", "totalSize", "percentDone"]
+STATUS_FIELDS = ["id", "status", "error"]
+MONITOR_FIELDS = ["id", "hashString", "name", "percentDone", "totalSize", "status", "eta"]
+TRACK_FIELDS = ["id", "name", "status", "percentDone", "totalSize", "rateDownload", "eta", "error", "errorString"]
+FILE_FIELDS = ["id", "name", "files", "fileStats"]
+# Планировщику нужны каталог (категория) и приоритет полосы; без него эти поля не запрашиваются
+SCHEDULER_FIELDS = ["id", "hashString", "status", "percentDone", "addedDate", "downloadDir", "bandwidthPriority"]
+SNAPSHOT_FIELDS = sorted(
+    set(LIST_FIELDS) | set(DELETE_LIST_FIELDS) | set(STATUS_FIELDS) | set(MONITOR_FIELDS) | set(TRACK_FIELDS)
+    | (set(SCHEDULER_FIELDS) if DOWNLOAD_SCHEDULER_ENABLED else set())
+)
+
+# Метрики в формате Prometheus
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+metrics_registry = []
+
+def format_metric_labels(label: str, value) -> str:
+    """Метка Prometheus вида name="value" (пустая строка, если метки нет)"""
+    if label is None:
+        return ""
+    value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return f'{label}="{value}"'
+
+class Counter:
+    """Счетчик Prometheus с необязательной меткой"""
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, label: str = None):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self._values = {}
+        self._lock = threading.Lock()
+        metrics_registry.append(self)
+
+    def inc(self, label_value=None, amount: float = 1) -> None:
+        with self._lock:
+            self._values[label_value] = self._values.get(label_value, 0) + amount
+
+    def collect(self) -> dict:
+        with self._lock:
+            return dict(self._values)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        for label_value, value in sorted(self.collect().items(), key=lambda item: str(item[0])):
+            labels = format_metric_labels(self.label, label_value)
+            lines.append(f"{self.name}{{{labels}}} {value:g}" if labels else f"{self.name} {value:g}")
+        return lines
+
+class Gauge(Counter):
+    """Показатель Prometheus; значения берутся из collect_values в момент запроса метрик"""
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, label: str = None, collect_values=None):
+        super().__init__(name, help_text, label)
+        self.collect_values = collect_values
+
+    def collect(self) -> dict:
+        return self.collect_values() if self.collect_values else super().collect()
+
+class Histogram:
+    """Гистограмма Prometheus с необязательной меткой"""
+
+    def __init__(self, name: str, help_text: str, buckets, label: str = None):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.label = label
+        # значение метки -> [число наблюдений в каждом интервале..., сумма]
+        self._series = {}
+        self._lock = threading.Lock()
+        metrics_registry.append(self)
+
+    def observe(self, value: float, label_value=None) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted(((key, list(series)) for key, series in self._series.items()), key=lambda item: str(item[0]))
+
+        for label_value, series in items:
+            labels = format_metric_labels(self.label, label_value)
+            prefix = f"{labels}," if labels else ""
+            cumulative = 0
+            for bound, count in zip(self.buckets + (None,), series):
+                cumulative += count
+                le = "+Inf" if bound is None else f"{bound:g}"
+                lines.append(f'{self.name}_bucket{{{prefix}le="{le}"}} {cumulative}')
+            suffix = f"{{{labels}}}" if labels else ""
+            lines.append(f"{self.name}_sum{suffix} {series[-1]:g}")
+            lines.append(f"{self.name}_count{suffix} {cumulative}")
+        return lines
+
+def render_metrics() -> str:
+    """Все метрики в текстовом формате Prometheus"""
+    lines = []
+    for metric in metrics_registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+rpc_duration = Histogram("transmission_rpc_duration_seconds", "Время вызова Transmission RPC", LATENCY_BUCKETS, "method")
+rpc_response_bytes = Histogram("transmission_rpc_response_bytes", "Размер ответа Transmission RPC", SIZE_BUCKETS, "method")
+rpc_errors = Counter("transmission_rpc_errors_total", "Ошибки вызовов Transmission RPC", "method")
+handler_duration = Histogram("bot_handler_duration_seconds", "Время обработки апдейта хендлером", LATENCY_BUCKETS, "handler")
+handler_errors = Counter("bot_handler_errors_total", "Исключения в хендлерах", "handler")
+poll_duration = Histogram("bot_monitor_poll_duration_seconds", "Длительность опроса мониторинга", LATENCY_BUCKETS, "sync")
+telegram_send_failures = Counter("bot_telegram_send_failures_total", "Сообщения, которые не удалось доставить")
+telegram_flood_waits = Counter("bot_telegram_flood_waits_total", "Ответы Telegram с RetryAfter (flood control)")
+
+# Постоянные данные бота (SQLite)
+def open_state_db():
+    """Подключение к SQLite с состоянием бота"""
+    os.makedirs(DATA_DIR, exist_ok=True)
+    db = sqlite3.connect(STATE_DB_PATH)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    return db
+
+state_db = open_state_db()
+
+# Хранилище сессий пользователей
+class MemorySessionBackend:
+    """Сессии в памяти процесса (теряются при перезапуске)"""
+
+    def __init__(self):
+        self._rows = OrderedDict()
+
+    def load(self, key: str, now: float):
+        row = self._rows.get(key)
+        if row is None:
+            return None
+        if row[0] <= now:
+            del self._rows[key]
+            return None
+        return row[1]
+
+    def save(self, key: str, value, expires_at: float, max_entries: int) -> None:
+        self._rows[key] = (expires_at, value)
+        self._rows.move_to_end(key)
+        while len(self._rows) > max_entries:
+            self._rows.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        self._rows.pop(key, None)
+
+    def purge(self, now: float) -> None:
+        for key in [key for key, (expires_at, _) in self._rows.items() if expires_at <= now]:
+            del self._rows[key]
+
+class SqliteSessionBackend:
+    """Сессии в SQLite: незавершенные диалоги переживают перезапуск"""
+
+    def __init__(self, db):
+        self.db = db
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS user_sessions ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS user_sessions_updated_at ON user_sessions (updated_at)")
+        self.db.commit()
+
+    def load(self, key: str, now: float):
+        row = self.db.execute("SELECT value, expires_at FROM user_sessions WHERE key = ?", (key,)).fetchone()
+        if row is None or row[1] <= now:
+            return None
+        return pickle.loads(row[0])
+
+    def save(self, key: str, value, expires_at: float, max_entries: int) -> None:
+        with self.db:
+            self.db.execute(
+                "INSERT INTO user_sessions (key, value, expires_at, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value, "
+                "expires_at = excluded.expires_at, updated_at = excluded.updated_at",
+                (key, pickle.dumps(value), expires_at, time.time())
+            )
+            self.db.execute(
+                "DELETE FROM user_sessions WHERE key IN "
+                "(SELECT key FROM user_sessions ORDER BY updated_at DESC LIMIT -1 OFFSET ?)",
+                (max_entries,)
+            )
+
+    def delete(self, key: str) -> None:
+        with self.db:
+            self.db.execute("DELETE FROM user_sessions WHERE key = ?", (key,))
+
+    def purge(self, now: float) -> None:
+        with self.db:
+            self.db.execute("DELETE FROM user_sessions WHERE expires_at <= ?", (now,))
+
+class UserSessionStore:
+    """Временные данные диалогов пользователей с TTL и ограничением числа записей"""
+
+    def __init__(self, backend, ttl: float, max_entries: int):
+        self.backend = backend
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._purged_at = 0.0
+
+    def get(self, user_id: int, field: str, default=None):
+        value = self.backend.load(f"{user_id}:{field}", time.time())
+        return default if value is None else value
+
+    def set(self, user_id: int, field: str, value, ttl: float = None) -> None:
+        now = time.time()
+        if now - self._purged_at >= SESSION_PURGE_INTERVAL:
+            self.backend.purge(now)
+            self._purged_at = now
+        self.backend.save(f"{user_id}:{field}", value, now + (ttl or self.ttl), self.max_entries)
+
+    def pop(self, user_id: int, field: str, default=None):
+        value = self.get(user_id, field, default)
+        self.backend.delete(f"{user_id}:{field}")
+        return value
+
+def create_session_backend():
+    """Хранилище сессий по настройке SESSION_BACKEND"""
+    if SESSION_BACKEND == "memory":
+        return MemorySessionBackend()
+    return SqliteSessionBackend(state_db)
+
+# magnet-ссылки, выбранные для удаления торренты и FSM-состояния диалогов
+sessions = UserSessionStore(create_session_backend(), SESSION_TTL, SESSION_MAX_ENTRIES)
+# .torrent файлы, пакеты массового добавления и списки файлов торрентов - только в памяти: мегабайты данных не пишем в SQLite
+pending_uploads = UserSessionStore(MemorySessionBackend(), PENDING_UPLOAD_TTL, SESSION_MAX_ENTRIES)
+bulk_prompt_tasks = {}
+
+class SessionFSMStorage(BaseStorage):
+    """FSM-хранилище aiogram поверх сессий пользователей"""
+
+    def __init__(self, store: UserSessionStore):
+        self.store = store
+
+    @staticmethod
+    def _field(key, name: str) -> str:
+        return f"fsm_{name}:{key.bot_id}:{key.chat_id}:{key.thread_id}:{key.business_connection_id}:{key.destiny}"
+
+    async def set_state(self, key, state=None) -> None:
+        state = state.state if isinstance(state, State) else state
+        if state is None:
+            self.store.pop(key.user_id, self._field(key, "state"))
+        else:
+            self.store.set(key.user_id, self._field(key, "state"), state)
+
+    async def get_state(self, key):
+        return self.store.get(key.user_id, self._field(key, "state"))
+
+    async def set_data(self, key, data) -> None:
+        if data:
+            self.store.set(key.user_id, self._field(key, "data"), dict(data))
+        else:
+            self.store.pop(key.user_id, self._field(key, "data"))
+
+    async def get_data(self, key) -> dict:
+        return dict(self.store.get(key.user_id, self._field(key, "data"), {}))
+
+    async def close(self) -> None:
+        pass
+
 # Инициализация бота и диспетчера
 bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
+storage = SessionFSMStorage(sessions)
 dp = Dispatcher(storage=storage)
 
+async def observe_handler(handler, event, data):
+    """Middleware: время работы и исключения хендлеров для метрик"""
+    name = data["handler"].callback.__name__
+    started = time.monotonic()
+    try:
+        return await handler(event, data)
+    except Exception:
+        handler_errors.inc(name)
+        raise
+    finally:
+        handler_duration.observe(time.monotonic() - started, name)
+
+dp.message.middleware(observe_handler)
+dp.callback_query.middleware(observe_handler)
+dp.inline_query.middleware(observe_handler)
+
 # FSM States для управления диалогом
 class TorrentStates(StatesGroup):
     waiting_for_category = State()
     selecting_torrent_to_delete = State()
     confirming_deletion = State()
 
-# Временное хранилище для magnet-ссылок, .torrent файлов и выбранных торрентов
-user_magnets = {}
-user_torrent_files = {}
-user_selected_torrents = {}
-delete_page = {}
-
-def cleanup_user_torrent_file(user_id: int) -> None:
-    """Удаляет временный .torrent файл пользователя"""
-    torrent_path = user_torrent_files.pop(user_id, None)
-    if not torrent_path:
-        return
-    try:
-        os.remove(torrent_path)
-    except FileNotFoundError:
-        return
-    except Exception as e:
-        print(f"Ошибка при удалении временного .torrent файла: {e}")
-
 # Подключение к Transmission
 def get_transmission_client():
     """Создание клиента Transmission с параметрами из env"""
@@ -76,10 +476,265 @@ def get_transmission_client():
         host=TRANSMISSION_HOST,
         port=TRANSMISSION_PORT,
         username=TRANSMISSION_USER if TRANSMISSION_USER else None,
-        password=TRANSMISSION_PASS if TRANSMISSION_PASS else None
+        password=TRANSMISSION_PASS if TRANSMISSION_PASS else None,
+        timeout=(RPC_CONNECT_TIMEOUT, RPC_TIMEOUT)
+    )
+
+# Синхронный transmission_rpc выполняется в пуле потоков, чтобы не блокировать event loop.
+# У каждого потока свой клиент (и свое keep-alive соединение)
+rpc_executor = ThreadPoolExecutor(max_workers=RPC_WORKERS, thread_name_prefix="transmission_rpc")
+rpc_semaphore = asyncio.Semaphore(RPC_WORKERS)
+rpc_local = threading.local()
+# Увеличивается, когда все клиенты потоков нужно пересоздать (демон перезапущен или недоступен)
+rpc_client_generation = 0
+
+def reset_rpc_clients() -> None:
+    """Пересоздание клиентов всех потоков при следующем вызове"""
+    global rpc_client_generation
+    rpc_client_generation += 1
+
+def get_thread_client():
+    """Клиент Transmission текущего потока пула (создается при первом обращении)"""
+    thread_client = getattr(rpc_local, "client", None)
+    if thread_client is None or rpc_local.generation != rpc_client_generation:
+        generation = rpc_client_generation
+        thread_client = get_transmission_client()
+        thread_client._http_session.hooks["response"].append(record_response_size)
+        rpc_local.client = thread_client
+        rpc_local.generation = generation
+    return thread_client
+
+def record_response_size(response, *args, **kwargs):
+    """Хук requests: размер ответов RPC текущего вызова"""
+    rpc_local.response_bytes = getattr(rpc_local, "response_bytes", 0) + len(response.content)
+
+def run_rpc_method(method: str, args: tuple, kwargs: dict, convert=None):
+    """Вызов метода клиента Transmission внутри потока пула; convert обрабатывает результат там же"""
+    rpc_local.response_bytes = 0
+    try:
+        result = getattr(get_thread_client(), method)(*args, **kwargs)
+    except (transmission_rpc.TransmissionConnectError, transmission_rpc.TransmissionAuthError):
+        # Соединение или авторизация сброшены - следующий вызов этого потока подключится заново
+        rpc_local.client = None
+        raise
+    finally:
+        rpc_response_bytes.observe(rpc_local.response_bytes, method)
+    return result if convert is None else convert(result)
+
+# Устойчивость RPC: повторы с экспоненциальной задержкой и circuit breaker
+RPC_RETRY_METHODS = {
+    "get_session", "session_stats", "get_torrent", "get_torrents",
+    "get_recently_active_torrents", "free_space",
+}
+
+class TransmissionUnavailableError(transmission_rpc.TransmissionConnectError):
+    """Circuit breaker разомкнут: запрос к Transmission не отправлялся"""
+
+class TransmissionBusyError(Exception):
+    """Все соединения с Transmission заняты дольше таймаута: запрос не отправлялся"""
+
+class CircuitBreaker:
+    """Размыкается после серии сбоев подключения; затем раз в cooldown пропускает один пробный вызов"""
+
+    def __init__(self, failure_threshold: int, cooldown: float):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def before_call(self) -> bool:
+        """Проверка перед вызовом; True, если это пробный вызов после паузы"""
+        if self.opened_at is None:
+            return False
+        remaining = self.opened_at + self.cooldown - time.monotonic()
+        if remaining > 0 or self._probing:
+            raise TransmissionUnavailableError(
+                f"Transmission недоступен, повторная попытка через {max(1, round(remaining))} сек"
+            )
+        self._probing = True
+        return True
+
+    def record_success(self) -> None:
+        if self.opened_at is not None:
+            print("✅ Transmission снова доступен")
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self._probing or self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                print(f"⛔ Transmission недоступен после {self.failures} сбоев, пауза {self.cooldown:g} сек")
+                reset_rpc_clients()
+            self.opened_at = time.monotonic()
+            self._probing = False
+
+    def release_probe(self) -> None:
+        """Пробный вызов отменен, не дождавшись ответа"""
+        self._probing = False
+
+class RetryBudget:
+    """Повторы расходуют токены, успешные вызовы их пополняют: сбои не умножают нагрузку на демон"""
+
+    def __init__(self, ratio: float, capacity: float):
+        self.ratio = ratio
+        self.capacity = capacity
+        self.tokens = capacity
+
+    def deposit(self) -> None:
+        self.tokens = min(self.capacity, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+def get_retry_delay(attempt: int) -> float:
+    """Экспоненциальная задержка перед повтором со случайным разбросом"""
+    delay = min(RPC_RETRY_MAX_DELAY, RPC_RETRY_BASE_DELAY * 2 ** attempt)
+    return random.uniform(delay / 2, delay)
+
+rpc_breaker = CircuitBreaker(RPC_BREAKER_FAILURES, RPC_BREAKER_COOLDOWN)
+rpc_retry_budget = RetryBudget(RPC_RETRY_BUDGET_RATIO, RPC_RETRY_BUDGET_CAPACITY)
+rpc_breaker_open = Gauge(
+    "transmission_rpc_circuit_open", "Circuit breaker RPC разомкнут",
+    collect_values=lambda: {None: int(rpc_breaker.is_open)}
+)
+
+async def rpc_call(method: str, *args, timeout: float = RPC_TIMEOUT, convert=None, **kwargs):
+    """Вызов метода transmission_rpc.Client через circuit breaker; читающие методы повторяются при сбое связи"""
+    attempts = 1 + (RPC_RETRIES if method in RPC_RETRY_METHODS else 0)
+
+    for attempt in range(attempts):
+        probing = rpc_breaker.before_call()
+        try:
+            result = await rpc_attempt(method, args, dict(kwargs), timeout, convert)
+        except TransmissionBusyError:
+            # Очередь внутри бота ничего не говорит о состоянии демона
+            if probing:
+                rpc_breaker.release_probe()
+            raise
+        except transmission_rpc.TransmissionConnectError:
+            rpc_breaker.record_failure()
+            if attempt + 1 >= attempts or rpc_breaker.is_open or not rpc_retry_budget.withdraw():
+                raise
+            await asyncio.sleep(get_retry_delay(attempt))
+        except Exception:
+            # Демон ответил (например, торрент не найден) - связь в порядке
+            rpc_breaker.record_success()
+            raise
+        except BaseException:
+            if probing:
+                rpc_breaker.release_probe()
+            raise
+        else:
+            rpc_breaker.record_success()
+            rpc_retry_budget.deposit()
+            return result
+
+def release_rpc_slot(future) -> None:
+    rpc_semaphore.release()
+    # Результат запроса, брошенного по таймауту, никто не заберет - не даем asyncio ругаться
+    if not future.cancelled():
+        future.exception()
+
+async def rpc_attempt(method: str, args: tuple, kwargs: dict, timeout: float, convert=None):
+    """Одна попытка вызова в пуле потоков с ограничением параллельности и таймаутом"""
+    kwargs["timeout"] = (min(RPC_CONNECT_TIMEOUT, timeout), timeout)
+    loop = asyncio.get_running_loop()
+
+    # Ожидание свободного потока не входит в таймаут запроса и не считается сбоем связи
+    try:
+        await asyncio.wait_for(rpc_semaphore.acquire(), timeout)
+    except asyncio.TimeoutError:
+        rpc_errors.inc(method)
+        raise TransmissionBusyError(f"Все соединения с Transmission заняты дольше {timeout:g} сек ({method})")
+
+    future = loop.run_in_executor(rpc_executor, functools.partial(run_rpc_method, method, args, kwargs, convert))
+    # Слот освобождается, когда поток действительно закончит, даже если вызывающий уже получил таймаут
+    future.add_done_callback(release_rpc_slot)
+
+    started = time.monotonic()
+    try:
+        return await asyncio.wait_for(asyncio.shield(future), timeout)
+    except asyncio.TimeoutError:
+        rpc_errors.inc(method)
+        raise transmission_rpc.TransmissionTimeoutError(f"Transmission не ответил за {timeout:g} сек ({method})")
+    except Exception:
+        rpc_errors.inc(method)
+        raise
+    finally:
+        rpc_duration.observe(time.monotonic() - started, method)
+
+# Компактные записи торрентов
+# Коды статусов torrent-get (RPC 14+)
+TORRENT_STATUSES = {
+    0: "stopped",
+    1: "check pending",
+    2: "checking",
+    3: "download pending",
+    4: "downloading",
+    5: "seed pending",
+    6: "seeding",
+}
+
+class TorrentRecord:
+    """Только используемые ботом поля торрента; хранится в кешах вместо transmission_rpc.Torrent"""
+    __slots__ = (
+        "id", "hash_string", "name", "status", "percent_done", "total_size",
+        "error", "error_string", "added_date", "done_date", "eta", "rate_download",
+        "download_dir", "bandwidth_priority",
     )
 
-client = get_transmission_client()
+    def __init__(self, fields: dict):
+        self.id = fields["id"]
+        self.hash_string = fields.get("hashString", "")
+        self.name = fields.get("name", "")
+        self.status = TORRENT_STATUSES.get(fields.get("status"), "stopped")
+        self.percent_done = fields.get("percentDone", 0.0)
+        self.total_size = fields.get("totalSize", 0)
+        self.error = fields.get("error", 0)
+        self.error_string = fields.get("errorString", "")
+        # Unix-время; 0 - неизвестно
+        self.added_date = fields.get("addedDate", 0)
+        self.done_date = fields.get("doneDate", 0)
+        # Секунды до завершения; -1 - неизвестно, -2 - бесконечно
+        self.eta = fields.get("eta", -1)
+        self.rate_download = fields.get("rateDownload", 0)
+        # Каталоги у тысяч торрентов совпадают - храним одну копию строки
+        self.download_dir = sys.intern(fields.get("downloadDir", ""))
+        # -1 низкий, 0 обычный, 1 высокий
+        self.bandwidth_priority = fields.get("bandwidthPriority", 0)
+
+    def __eq__(self, other):
+        if not isinstance(other, TorrentRecord):
+            return NotImplemented
+        return all(getattr(self, field) == getattr(other, field) for field in self.__slots__)
+
+    @property
+    def progress(self) -> float:
+        """Прогресс в процентах (как transmission_rpc.Torrent.progress)"""
+        return round(100.0 * self.percent_done, 2)
+
+def to_record(torrent) -> TorrentRecord:
+    """Запись из ответа transmission_rpc (выполняется в потоке пула)"""
+    return TorrentRecord(torrent.fields)
+
+def to_records(torrents) -> list:
+    """Список записей из списка transmission_rpc.Torrent"""
+    return [TorrentRecord(t.fields) for t in torrents]
+
+def to_active_records(result) -> tuple:
+    """Результат get_recently_active_torrents: (записи изменившихся, id удаленных)"""
+    active, removed = result
+    return to_records(active), removed
 
 # Проверка прав доступа
 def check_access(user_id: int) -> bool:
@@ -109,6 +764,19 @@ def escape_markdown(text: str) -> str:
         .replace('`', '\\`')
     )
 
+# Разбиение длинного текста на сообщения
+def split_message(header: str, lines) -> list:
+    """Сообщения с общим заголовком, каждое не длиннее лимита Telegram"""
+    messages = []
+    text = header
+    for line in lines:
+        if len(text) + len(line) > TELEGRAM_MESSAGE_LIMIT and text != header:
+            messages.append(text)
+            text = header
+        text += line
+    messages.append(text)
+    return messages
+
 # Получение emoji для статуса
 def get_status_emoji(status: str) -> str:
     """Получение emoji в зависимости от статуса торрента"""
@@ -124,18 +792,18 @@ def get_status_emoji(status: str) -> str:
     return status_map.get(status.lower(), EMOJI_PAUSED)
 
 # Приоритет статусов для сортировки
+DOWNLOADING_STATUSES = {"downloading", "download pending"}
+SEEDING_STATUSES = {"seeding", "seed pending"}
+
 def get_status_priority(torrent) -> tuple:
     """Определение приоритета статуса для сортировки"""
-    status = torrent.status.lower()
-
-    # Проверяем есть ли ошибки
-    has_error = torrent.error != 0 or (hasattr(torrent, 'error_string') and torrent.error_string)
+    status = torrent.status
 
-    if status == "downloading" or status == "download pending":
+    if status in DOWNLOADING_STATUSES:
         priority = 1
-    elif has_error:
+    elif torrent.error != 0 or torrent.error_string:
         priority = 2
-    elif status == "seeding" or status == "seed pending":
+    elif status in SEEDING_STATUSES:
         priority = 3
     else:
         priority = 4
@@ -143,32 +811,676 @@ def get_status_priority(torrent) -> tuple:
     # Сортируем по приоритету, потом по ID (обратный порядок - новые сверху)
     return (priority, -torrent.id)
 
+# Упорядоченный индекс торрентов
+class TorrentOrder:
+    """Отсортированные ключи (приоритет, -id) с точечным обновлением при изменении торрента"""
+
+    def __init__(self):
+        self._keys = {}
+        self._order = []
+
+    def __len__(self) -> int:
+        return len(self._order)
+
+    def rebuild(self, torrents) -> None:
+        """Полное построение индекса"""
+        self._keys = {t.id: get_status_priority(t) for t in torrents}
+        self._order = sorted(self._keys.values())
+
+    def update(self, torrent) -> None:
+        """Добавление торрента или перемещение при смене статуса"""
+        key = get_status_priority(torrent)
+        old_key = self._keys.get(torrent.id)
+        if old_key == key:
+            return
+        if old_key is not None:
+            del self._order[bisect.bisect_left(self._order, old_key)]
+        self._keys[torrent.id] = key
+        bisect.insort(self._order, key)
+
+    def remove(self, torrent_id: int) -> None:
+        """Удаление торрента из индекса"""
+        old_key = self._keys.pop(torrent_id, None)
+        if old_key is not None:
+            del self._order[bisect.bisect_left(self._order, old_key)]
+
+    def slice_ids(self, start: int, end: int) -> list:
+        """ID торрентов на позициях [start, end)"""
+        return [-key[1] for key in self._order[start:end]]
+
+    def ids_with_priority(self, priority: int) -> list:
+        """ID торрентов с заданным приоритетом сортировки"""
+        start = bisect.bisect_left(self._order, (priority,))
+        end = bisect.bisect_left(self._order, (priority + 1,))
+        return [-key[1] for key in self._order[start:end]]
+
+    def sort_ids(self, torrent_ids) -> list:
+        """ID в порядке сортировки списка"""
+        return sorted(torrent_ids, key=self._keys.__getitem__)
+
+# Индекс имен торрентов для поиска
+def tokenize_name(text: str) -> set:
+    """Слова имени в нижнем регистре"""
+    return set(NAME_TOKEN_PATTERN.findall(text.lower()))
+
+class TorrentNameIndex:
+    """Обратный индекс слов имен: поиск по началу слов без запросов к Transmission"""
+
+    def __init__(self):
+        self._ids_by_token = {}
+        self._tokens_by_id = {}
+        self._sorted_tokens = []
+
+    def rebuild(self, torrents) -> None:
+        """Полное построение индекса"""
+        self._ids_by_token = {}
+        self._tokens_by_id = {}
+        for t in torrents:
+            tokens = self._tokens_by_id[t.id] = tokenize_name(t.name)
+            for token in tokens:
+                self._ids_by_token.setdefault(token, set()).add(t.id)
+        self._sorted_tokens = sorted(self._ids_by_token)
+
+    def update(self, torrent) -> None:
+        """Добавление торрента или обновление при смене имени"""
+        tokens = tokenize_name(torrent.name)
+        old_tokens = self._tokens_by_id.get(torrent.id, set())
+        if tokens == old_tokens:
+            return
+        self._discard(torrent.id, old_tokens - tokens)
+        for token in tokens - old_tokens:
+            ids = self._ids_by_token.get(token)
+            if ids is None:
+                ids = self._ids_by_token[token] = set()
+                bisect.insort(self._sorted_tokens, token)
+            ids.add(torrent.id)
+        self._tokens_by_id[torrent.id] = tokens
+
+    def remove(self, torrent_id: int) -> None:
+        """Удаление торрента из индекса"""
+        self._discard(torrent_id, self._tokens_by_id.pop(torrent_id, set()))
+
+    def _discard(self, torrent_id: int, tokens) -> None:
+        for token in tokens:
+            ids = self._ids_by_token[token]
+            ids.discard(torrent_id)
+            if not ids:
+                del self._ids_by_token[token]
+                del self._sorted_tokens[bisect.bisect_left(self._sorted_tokens, token)]
+
+    def _ids_with_prefix(self, prefix: str) -> set:
+        ids = set()
+        position = bisect.bisect_left(self._sorted_tokens, prefix)
+        while position < len(self._sorted_tokens) and self._sorted_tokens[position].startswith(prefix):
+            ids |= self._ids_by_token[self._sorted_tokens[position]]
+            position += 1
+        return ids
+
+    def search(self, query: str) -> set:
+        """ID торрентов, в имени которых каждое слово запроса - начало какого-то слова"""
+        # Длинные слова запроса обычно избирательнее - с них и начинаем пересечение
+        words = sorted(set(NAME_TOKEN_PATTERN.findall(query.lower())), key=len, reverse=True)
+        if not words:
+            return set()
+        ids = self._ids_with_prefix(words[0])
+        for word in words[1:]:
+            if not ids:
+                break
+            ids &= self._ids_with_prefix(word)
+        return ids
+
+# Общий снимок списка торрентов для всех представлений и мониторинга
+class TorrentSnapshot:
+    """Кеш результата torrent-get с TTL и единственным одновременным обновлением"""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._by_id = {}
+        self._list = []
+        self.order = TorrentOrder()
+        # Индекс имен строится лениво при первом поиске, дальше обновляется по изменениям снимка
+        self.names = TorrentNameIndex()
+        self._names_stale = True
+        self._names_build = None
+        self.version = 0
+        self.fetched_at = 0.0
+        self._generation = 0
+        self._refresh_task = None
+
+    @property
+    def torrents(self):
+        """Текущий список торрентов снимка"""
+        if self._list is None:
+            self._list = list(self._by_id.values())
+        return self._list
+
+    def get_torrent(self, torrent_id: int):
+        """Торрент из снимка или None"""
+        return self._by_id.get(torrent_id)
+
+    def ids(self):
+        """ID всех торрентов снимка"""
+        return self._by_id.keys()
+
+    def get_downloading(self) -> list:
+        """Загружающиеся торренты (первыми идут в порядке сортировки)"""
+        return [self._by_id[torrent_id] for torrent_id in self.order.ids_with_priority(1)]
+
+    def get_sorted(self, start: int, end: int):
+        """Торренты в порядке сортировки на позициях [start, end)"""
+        return [self._by_id[torrent_id] for torrent_id in self.order.slice_ids(start, end)]
+
+    async def search(self, query: str, limit: int) -> list:
+        """Торренты снимка, подходящие под запрос, в порядке сортировки списка"""
+        names = await self._get_names()
+        torrent_ids = [torrent_id for torrent_id in names.search(query) if torrent_id in self._by_id]
+        return [self._by_id[torrent_id] for torrent_id in self.order.sort_ids(torrent_ids)[:limit]]
+
+    async def _get_names(self):
+        """Индекс имен; устаревший перестраивается в потоке, параллельные поиски ждут одну сборку"""
+        if self._names_build is None and self._names_stale:
+            self._names_build = asyncio.ensure_future(self._build_names())
+        if self._names_build is not None:
+            return await asyncio.shield(self._names_build)
+        return self.names
+
+    async def _build_names(self):
+        version = self.version
+        names = TorrentNameIndex()
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, names.rebuild, list(self._by_id.values()))
+        finally:
+            self._names_build = None
+        # Если снимок менялся во время сборки, индекс годится для этого поиска, но не сохраняется
+        if self.version == version:
+            self.names = names
+            self._names_stale = False
+        return names
+
+    def is_fresh(self, max_age: float = None) -> bool:
+        """Снимок моложе max_age (по умолчанию TTL)"""
+        max_age = self.ttl if max_age is None else max_age
+        return self.version > 0 and time.monotonic() - self.fetched_at < max_age
+
+    def invalidate(self) -> None:
+        """Сброс снимка после изменений (добавление, удаление торрентов)"""
+        self._generation += 1
+        self.fetched_at = 0.0
+
+    async def ensure_fresh(self, max_age: float = None) -> None:
+        """Обновление снимка, если он старше max_age; ждет общего обновления"""
+        if not self.is_fresh(max_age):
+            await self.refresh()
+
+    async def ensure_loaded(self) -> None:
+        """Загрузка снимка, только если его еще нет: дальше его держит актуальным мониторинг"""
+        if self.version == 0:
+            await self.refresh()
+
+    async def get(self, max_age: float = None):
+        """Список торрентов не старше max_age"""
+        await self.ensure_fresh(max_age)
+        return self.torrents
+
+    async def refresh(self):
+        """Обновление снимка; параллельные вызовы ждут один и тот же RPC-запрос"""
+        if self._refresh_task is None:
+            self._refresh_task = asyncio.create_task(self._fetch())
+            self._refresh_task.add_done_callback(self._refresh_done)
+        return await asyncio.shield(self._refresh_task)
+
+    def _refresh_done(self, task) -> None:
+        if self._refresh_task is task:
+            self._refresh_task = None
+        if not task.cancelled():
+            task.exception()
+
+    async def _fetch(self):
+        generation = self._generation
+        torrents = await rpc_call("get_torrents", arguments=SNAPSHOT_FIELDS, convert=to_records)
+        by_id = {t.id: t for t in torrents}
+        # Без изменений сохраняем прежний снимок и версию: кеш отрисованных страниц остается годным
+        changed = by_id != self._by_id
+        if changed:
+            old_by_id = self._by_id
+            self._by_id = by_id
+            self._list = torrents
+            self.order.rebuild(torrents)
+            if not self._names_stale:
+                # Индекс имен не перестраиваем: переносим только новые, переименованные и удаленные
+                for t in torrents:
+                    old = old_by_id.get(t.id)
+                    if old is None or old.name != t.name:
+                        self.names.update(t)
+                for torrent_id in old_by_id.keys() - self._by_id.keys():
+                    self.names.remove(torrent_id)
+        self._mark_updated(generation, changed)
+        return torrents
+
+    async def refresh_delta(self):
+        """Применение изменений recently-active к снимку; возвращает (изменившиеся торренты, id удаленных)"""
+        if self._refresh_task is not None:
+            await asyncio.shield(self._refresh_task)
+
+        generation = self._generation
+        active, removed = await rpc_call("get_recently_active_torrents", arguments=SNAPSHOT_FIELDS, convert=to_active_records)
+        changed = self._apply_changes(active, removed)
+        self._mark_updated(generation, changed)
+        return active, removed
+
+    def merge(self, torrents) -> None:
+        """Точечное обновление снимка свежими записями (после изменений, сделанных самим ботом)"""
+        if self._apply_changes(torrents, ()):
+            self.version += 1
+
+    def _apply_changes(self, active, removed) -> bool:
+        """Перенос изменившихся и удаленных торрентов в снимок; False - ничего не изменилось"""
+        changed = False
+        for torrent in active:
+            if self._by_id.get(torrent.id) == torrent:
+                continue
+            self._by_id[torrent.id] = torrent
+            self.order.update(torrent)
+            if not self._names_stale:
+                self.names.update(torrent)
+            changed = True
+        for torrent_id in removed:
+            if self._by_id.pop(torrent_id, None) is None:
+                continue
+            self.order.remove(torrent_id)
+            if not self._names_stale:
+                self.names.remove(torrent_id)
+            changed = True
+        if changed:
+            self._list = None
+        return changed
+
+    def _mark_updated(self, generation: int, changed: bool) -> None:
+        # Первая загрузка меняет версию всегда: version > 0 означает, что снимок получен
+        if changed or self.version == 0:
+            self.version += 1
+        # Если во время запроса снимок был сброшен, данные могли устареть
+        self.fetched_at = time.monotonic() if generation == self._generation else 0.0
+
+torrent_snapshot = TorrentSnapshot(SNAPSHOT_TTL)
+
+def count_torrents_by_status() -> dict:
+    """Число торрентов снимка по статусам (для метрик)"""
+    counts = {}
+    if torrent_snapshot.version > 0:
+        for t in torrent_snapshot.torrents:
+            counts[t.status] = counts.get(t.status, 0) + 1
+    return counts
+
+torrents_by_status = Gauge("transmission_torrents", "Торренты в снимке по статусу", "status", count_torrents_by_status)
+
+# Кеш отрисованных страниц списков
+class RenderCache:
+    """LRU готовых страниц (текст и клавиатуры); ключ включает версию снимка"""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._pages = OrderedDict()
+        self._version = 0
+
+    def get(self, key):
+        """Готовая страница или None"""
+        page = self._pages.get(key)
+        if page is not None:
+            self._pages.move_to_end(key)
+        return page
+
+    def put(self, key, page, version: int) -> None:
+        """Сохранение страницы; страницы старых версий снимка сбрасываются"""
+        if self.maxsize <= 0:
+            return
+        if version != self._version:
+            self._pages.clear()
+            self._version = version
+        self._pages[key] = page
+        self._pages.move_to_end(key)
+        while len(self._pages) > self.maxsize:
+            self._pages.popitem(last=False)
+
+rendered_pages = RenderCache(RENDER_CACHE_SIZE)
+
 # Подсчет статусов торрентов
 def get_status_counts(torrents):
-    """Подсчет статусов торрентов"""
-    active = sum(1 for t in torrents if t.status == "downloading")
-    seeding = sum(1 for t in torrents if t.status == "seeding")
-    paused = sum(1 for t in torrents if t.status == "stopped")
-    errors = sum(1 for t in torrents if t.error != 0)
-    total = len(torrents)
-    return active, seeding, paused, errors, total
-
-# Сортировка торрентов
-def sort_torrents(torrents):
-    """Сортировка: загружающиеся -> с ошибками -> готовые -> остальные"""
+    """Подсчет статусов торрентов за один проход"""
+    active = seeding = paused = errors = 0
+    for t in torrents:
+        status = t.status
+        if status == "downloading":
+            active += 1
+        elif status == "seeding":
+            seeding += 1
+        elif status == "stopped":
+            paused += 1
+        if t.error != 0:
+            errors += 1
+    return active, seeding, paused, errors, len(torrents)
+
+# История скоростей и активности
+HISTORY_METRICS = ("download", "upload", "active", "free")
+SPARKLINE_CHARS = "▁▂▃▄▅▆▇█"
+
+class HistoryBuffer:
+    """Кольцевой буфер средних значений за интервалы step: по массиву array на показатель, память постоянна"""
+
+    def __init__(self, step: int, size: int, metrics):
+        self.step = step
+        self.size = size
+        # Номер интервала (время // step), которому принадлежит ячейка; -1 - пусто
+        self.slots = array("q", [-1]) * size
+        self.counts = array("q", [0]) * size
+        self.sums = {metric: array("d", [0.0]) * size for metric in metrics}
+
+    def add(self, timestamp: float, values: dict) -> None:
+        """Учет замера в ячейке его интервала (старое значение ячейки затирается)"""
+        slot = int(timestamp // self.step)
+        index = slot % self.size
+        if slot < self.slots[index]:
+            # Замер старше ячейки (перевод часов назад) - не затираем более новые данные
+            return
+        if self.slots[index] != slot:
+            self.slots[index] = slot
+            self.counts[index] = 0
+            for sums in self.sums.values():
+                sums[index] = 0.0
+        self.counts[index] += 1
+        for metric, value in values.items():
+            self.sums[metric][index] += value
+
+    def series(self, metric: str, now: float) -> list:
+        """Средние по интервалам от старых к новым; None - замеров не было"""
+        last = int(now // self.step)
+        values = []
+        for slot in range(last - self.size + 1, last + 1):
+            index = slot % self.size
+            if self.slots[index] == slot and self.counts[index]:
+                values.append(self.sums[metric][index] / self.counts[index])
+            else:
+                values.append(None)
+        return values
+
+    def dump(self) -> dict:
+        return {
+            "step": self.step,
+            "size": self.size,
+            "slots": self.slots.tobytes(),
+            "counts": self.counts.tobytes(),
+            "sums": {metric: sums.tobytes() for metric, sums in self.sums.items()},
+        }
+
+    def restore(self, data: dict) -> None:
+        """Загрузка сохраненного буфера; при смене размеров ячеек данные пропускаются"""
+        if data.get("step") != self.step or data.get("size") != self.size:
+            return
+        slots, counts = array("q"), array("q")
+        slots.frombytes(data["slots"])
+        counts.frombytes(data["counts"])
+        if len(slots) != self.size or len(counts) != self.size:
+            return
+        self.slots, self.counts = slots, counts
+        for metric, raw in data["sums"].items():
+            if metric in self.sums:
+                sums = array("d")
+                sums.frombytes(raw)
+                if len(sums) == self.size:
+                    self.sums[metric] = sums
+
+class ActivityHistory:
+    """История скоростей, числа активных торрентов и свободного места в нескольких разрешениях"""
+
+    def __init__(self, db, resolutions, metrics):
+        self.db = db
+        self.buffers = {name: HistoryBuffer(step, size, metrics) for name, step, size in resolutions}
+        self.sampled_at = 0.0
+        self.saved_at = time.monotonic()
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS activity_history ("
+            "name TEXT PRIMARY KEY, data BLOB NOT NULL)"
+        )
+        self.db.commit()
+        for name, data in self.db.execute("SELECT name, data FROM activity_history"):
+            if name in self.buffers:
+                try:
+                    self.buffers[name].restore(pickle.loads(data))
+                except Exception as e:
+                    print(f"Ошибка загрузки истории {name}: {e}")
+
+    def add(self, timestamp: float, values: dict) -> None:
+        for buffer in self.buffers.values():
+            buffer.add(timestamp, values)
+
+    def save(self) -> None:
+        """Запись всех буферов одной транзакцией"""
+        with self.db:
+            self.db.executemany(
+                "INSERT INTO activity_history (name, data) VALUES (?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET data = excluded.data",
+                [(name, pickle.dumps(buffer.dump())) for name, buffer in self.buffers.items()]
+            )
+        self.saved_at = time.monotonic()
+
+activity_history = ActivityHistory(state_db, HISTORY_RESOLUTIONS, HISTORY_METRICS)
+
+# Каталог загрузки Transmission: запрашивается при старте и при добавлении торрентов
+transmission_download_dir = None
+
+async def get_download_dir(refresh: bool = False) -> str:
+    """Каталог загрузки Transmission (последний полученный через get_session)"""
+    global transmission_download_dir
+    if refresh or transmission_download_dir is None:
+        session = await rpc_call("get_session")
+        transmission_download_dir = session.download_dir
+    return transmission_download_dir
+
+async def record_activity() -> None:
+    """Замер для истории (не чаще HISTORY_SAMPLE_INTERVAL) и периодическое сохранение"""
+    now = time.monotonic()
+    if now - activity_history.sampled_at < HISTORY_SAMPLE_INTERVAL:
+        return
+    activity_history.sampled_at = now
+
+    stats = await rpc_call("session_stats")
+    free_space = await rpc_call("free_space", await get_download_dir())
+    activity_history.add(time.time(), {
+        "download": stats.download_speed,
+        "upload": stats.upload_speed,
+        "active": stats.active_torrent_count,
+        "free": free_space or 0,
+    })
+
+    if now - activity_history.saved_at >= HISTORY_SAVE_INTERVAL:
+        activity_history.save()
+
+def downsample(values: list, width: int) -> list:
+    """Усреднение соседних значений, чтобы график уместился в width символов"""
+    group = max(1, -(-len(values) // width))
+    result = []
+    for i in range(0, len(values), group):
+        known = [value for value in values[i:i + group] if value is not None]
+        result.append(sum(known) / len(known) if known else None)
+    return result
+
+def format_sparkline(values: list, from_zero: bool = True) -> str:
+    """Текстовый график из блоков ▁..█; пробел - нет данных"""
+    known = [value for value in values if value is not None]
+    if not known:
+        return ""
+    low = 0 if from_zero else min(known)
+    span = max(known) - low
+    top = len(SPARKLINE_CHARS) - 1
+    return "".join(
+        " " if value is None else SPARKLINE_CHARS[round((value - low) / span * top) if span else 0]
+        for value in values
+    )
+
+HISTORY_VIEWS = {"minute": "1 ч", "hour": "2 сут", "day": "30 дн"}
+
+def render_stats_message(resolution: str):
+    """Текст истории за выбранный период и кнопки переключения периода"""
+    buffer = activity_history.buffers[resolution]
+    now = time.time()
+    charts = (
+        ("download", "⬇️ Загрузка", lambda v: f"{format_size(v)}/s", True),
+        ("upload", "⬆️ Отдача", lambda v: f"{format_size(v)}/s", True),
+        ("active", "🔄 Активных", lambda v: f"{v:.0f}", True),
+        ("free", "💾 Свободно", format_size, False),
+    )
+
+    lines = [f"📈 *История за {HISTORY_VIEWS[resolution]}*"]
+    for metric, title, formatter, from_zero in charts:
+        values = buffer.series(metric, now)
+        known = [value for value in values if value is not None]
+        if not known:
+            continue
+        lines.append(
+            f"\n{title}: сейчас *{formatter(known[-1])}*, "
+            f"среднее {formatter(sum(known) / len(known))}, макс {formatter(max(known))}"
+        )
+        lines.append(f"`{format_sparkline(downsample(values, HISTORY_CHART_WIDTH), from_zero)}`")
+    if len(lines) == 1:
+        lines.append("\nДанных пока нет - история собирается при каждой проверке торрентов")
+
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(
+            text=f"• {label} •" if name == resolution else label,
+            callback_data=f"stats_{name}"
+        )
+        for name, label in HISTORY_VIEWS.items()
+    ]])
+    return "\n".join(lines), keyboard
+
+# Сводка статуса из session-stats
+async def get_status_data(breakdown=False):
+    """Агрегаты session-stats и, если нужно или уже есть в кеше, разбивка по статусам"""
+    stats = await rpc_call("session_stats")
+    counts = None
+    if breakdown or torrent_snapshot.is_fresh():
+        counts = get_status_counts(await torrent_snapshot.get())
+    return stats, counts
+
+def format_status_counts(stats, counts=None) -> str:
+    """Строки счетчиков торрентов для статуса"""
+    if counts is None:
+        return (
+            f"🔄 Активно: *{stats.active_torrent_count}*\n"
+            f"⏸️ Остановлено: *{stats.paused_torrent_count}*\n"
+            f"📦 Всего: *{stats.torrent_count}*"
+        )
+
+    active, seeding, paused, errors, total = counts
+    text = (
+        f"🔄 Загружается: *{active}*\n"
+        f"✅ Раздается: *{seeding}*\n"
+        f"⏸️ Остановлено: *{paused}*\n"
+    )
+
+    if errors > 0:
+        text += f"❌ С ошибками: *{errors}*\n"
+
+    text += f"📦 Всего: *{total}*"
+    return text
+
+async def get_status_message(breakdown=False):
+    """Текст статуса системы и кнопки: история и подробная разбивка (если ее еще нет)"""
+    stats, counts = await get_status_data(breakdown)
+
+    response = (
+        "📊 *Transmission Master Bot - Статус:*\n\n"
+        f"{format_status_counts(stats, counts)}\n\n"
+        f"⬇️ Скорость загрузки: *{format_size(stats.download_speed)}/s*\n"
+        f"⬆️ Скорость отдачи: *{format_size(stats.upload_speed)}/s*\n\n"
+    )
+    if DOWNLOAD_SCHEDULER_ENABLED and download_scheduler.summary:
+        response += download_scheduler.format_status() + "\n\n"
+
+    buttons = [InlineKeyboardButton(text="📈 История", callback_data="stats_minute")]
+    if counts is None:
+        buttons.insert(0, InlineKeyboardButton(text="🔍 Подробнее", callback_data="status_details"))
+
+    return response, InlineKeyboardMarkup(inline_keyboard=[buttons])
+
+# Быстрые повторные нажатия и правки без изменений
+class CallbackCoalescer:
+    """Для каждого сообщения обрабатывается только последнее нажатие; промежуточные сразу получают ответ"""
+
+    def __init__(self):
+        self._locks = {}
+        self._users = {}
+        self._waiting = {}
+
+    async def run(self, callback: CallbackQuery, render):
+        """Результат render() или None, если нажатие вытеснено более новым"""
+        key = (callback.message.chat.id, callback.message.message_id)
+        previous = self._waiting.get(key)
+        if previous is not None:
+            try:
+                await previous.answer()
+            except Exception:
+                pass
+        self._waiting[key] = callback
+
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        self._users[key] = self._users.get(key, 0) + 1
+        try:
+            async with lock:
+                if self._waiting.get(key) is not callback:
+                    return None
+                del self._waiting[key]
+                return await render()
+        finally:
+            self._users[key] -= 1
+            if not self._users[key]:
+                del self._users[key]
+                del self._locks[key]
+
+class ShownMessages:
+    """Хеши последнего показанного текста и клавиатуры сообщений (LRU)"""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._digests = OrderedDict()
+
+    @staticmethod
+    def digest(text: str, reply_markup=None) -> int:
+        return hash((text, reply_markup.model_dump_json() if reply_markup is not None else None))
+
+    def is_shown(self, message: Message, digest: int) -> bool:
+        return self._digests.get((message.chat.id, message.message_id)) == digest
+
+    def remember(self, message: Message, digest: int) -> None:
+        key = (message.chat.id, message.message_id)
+        self._digests[key] = digest
+        self._digests.move_to_end(key)
+        while len(self._digests) > self.maxsize:
+            self._digests.popitem(last=False)
+
+pagination_callbacks = CallbackCoalescer()
+shown_messages = ShownMessages(RENDER_CACHE_SIZE * 4)
+
+async def edit_message_if_changed(message: Message, text: str, reply_markup=None, **kwargs) -> bool:
+    """Правка сообщения, только если текст или клавиатура отличаются от показанных"""
+    digest = ShownMessages.digest(text, reply_markup)
+    if shown_messages.is_shown(message, digest):
+        return False
     try:
-        return sorted(torrents, key=get_status_priority)
-    except Exception as e:
-        print(f"Ошибка при сортировке торрентов: {e}")
-        return torrents
+        await message.edit_text(text, reply_markup=reply_markup, **kwargs)
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):
+            raise
+    shown_messages.remember(message, digest)
+    return True
 
 # Пагинация торрентов
-def paginate_torrents(torrents, page=0, per_page=9):
-    """Выборка торрентов по странице"""
-    total = len(torrents)
+def paginate_torrents(snapshot, page=0, per_page=9):
+    """Выборка торрентов страницы из упорядоченного индекса снимка"""
+    total = len(snapshot.order)
     start_idx = page * per_page
     end_idx = start_idx + per_page
-    page_torrents = torrents[start_idx:end_idx]
+    page_torrents = snapshot.get_sorted(start_idx, end_idx)
     return page_torrents, total, start_idx, end_idx
 
 def get_pagination_buttons(page, total, per_page, prefix):
@@ -210,21 +1522,26 @@ def get_main_keyboard():
     )
     return keyboard
 
+# Emoji категории загрузки
+def get_category_emoji(category: str) -> str:
+    """Emoji для категории загрузки"""
+    return {
+        "Movies": "🎬",
+        "Series": "📺",
+        "Music": "🎵",
+        "Other": "📁"
+    }.get(category, "📂")
+
 # Создание inline-клавиатуры для выбора категории
-def get_category_keyboard():
-    """Клавиатура для выбора категории загрузки"""
+def get_category_keyboard(pick_files: bool = None):
+    """Клавиатура для выбора категории загрузки; pick_files - переключатель выбора файлов (для .torrent)"""
     buttons = []
 
     for i in range(0, len(DOWNLOAD_CATEGORIES), 2):
         row = []
         for j in range(i, min(i + 2, len(DOWNLOAD_CATEGORIES))):
             category = DOWNLOAD_CATEGORIES[j].strip()
-            emoji = {
-                "Movies": "🎬",
-                "Series": "📺",
-                "Music": "🎵",
-                "Other": "📁"
-            }.get(category, "📂")
+            emoji = get_category_emoji(category)
 
             row.append(InlineKeyboardButton(
                 text=f"{emoji} {category}",
@@ -232,19 +1549,29 @@ def get_category_keyboard():
             ))
         buttons.append(row)
 
+    if pick_files is not None:
+        buttons.append([InlineKeyboardButton(
+            text=f"{'☑️' if pick_files else '⬜'} Выбрать файлы перед загрузкой",
+            callback_data="pick_files"
+        )])
     buttons.append([InlineKeyboardButton(text="❌ Отмена", callback_data="cancel")])
 
     keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
     return keyboard
 
 # Создание клавиатуры со списком торрентов для удаления
-def get_torrents_keyboard(page=0, per_page=9):
-    """Клавиатура со списком торрентов для удаления (по 9 штук)"""
+async def get_torrents_keyboard(page=0, per_page=9, selection=None):
+    """Клавиатура со списком торрентов для удаления (по 9 штук); selection - режим множественного выбора"""
     try:
-        torrents = client.get_torrents()
-        torrents = sort_torrents(torrents)
+        await torrent_snapshot.ensure_fresh()
+        version = torrent_snapshot.version
+        cache_key = ("delete", page, per_page, version)
+        if selection is None:
+            cached = rendered_pages.get(cache_key)
+            if cached is not None:
+                return cached
 
-        page_torrents, total, _, _ = paginate_torrents(torrents, page=page, per_page=per_page)
+        page_torrents, total, _, _ = paginate_torrents(torrent_snapshot, page=page, per_page=per_page)
 
         buttons = []
 
@@ -253,10 +1580,17 @@ def get_torrents_keyboard(page=0, per_page=9):
             name = torrent.name[:40] + "..." if len(torrent.name) > 40 else torrent.name
             emoji = get_status_emoji(torrent.status)
 
-            buttons.append([InlineKeyboardButton(
-                text=f"{emoji} {name}",
-                callback_data=f"delete_select_{torrent.id}"
-            )])
+            if selection is None:
+                buttons.append([InlineKeyboardButton(
+                    text=f"{emoji} {name}",
+                    callback_data=f"delete_select_{torrent.id}"
+                )])
+            else:
+                mark = "☑️" if torrent.id in selection else "⬜"
+                buttons.append([InlineKeyboardButton(
+                    text=f"{mark} {emoji} {name}",
+                    callback_data=f"delete_toggle_{torrent.id}"
+                )])
 
         # Навигация
         nav_buttons = get_pagination_buttons(page, total, per_page, "delete_page_")
@@ -264,51 +1598,122 @@ def get_torrents_keyboard(page=0, per_page=9):
         if nav_buttons:
             buttons.append(nav_buttons)
 
+        if selection is None:
+            buttons.append([InlineKeyboardButton(text="☑️ Выбрать несколько", callback_data="delete_multi")])
+        else:
+            buttons.append([
+                InlineKeyboardButton(text="❌ Все с ошибками", callback_data="delete_filter_errors"),
+                InlineKeyboardButton(text=f"🌱 Раздаются > {DELETE_SEED_DAYS} дн.", callback_data="delete_filter_seeding")
+            ])
+            buttons.append([
+                InlineKeyboardButton(text=f"🗑 Удалить выбранные ({len(selection)})", callback_data="delete_bulk"),
+                InlineKeyboardButton(text="🧹 Сбросить", callback_data="delete_clear")
+            ])
+
         # Кнопка отмены
         buttons.append([InlineKeyboardButton(text="❌ Отмена", callback_data="cancel")])
 
         keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
+        if selection is None:
+            rendered_pages.put(cache_key, (keyboard, total), version)
         return keyboard, total
 
     except Exception as e:
         print(f"Ошибка при получении списка торрентов: {e}")
         return None, 0
 
+def get_delete_list_text(page: int, total: int, selection=None) -> str:
+    """Заголовок страницы списка удаления"""
+    if selection is None:
+        return f"🗑 *Выберите торрент для удаления:*\n_Страница {page + 1}, всего торрентов: {total}_"
+    return (
+        "🗑 *Отметьте торренты для удаления:*\n"
+        f"_Страница {page + 1}, всего торрентов: {total}, выбрано: {len(selection)}_"
+    )
+
+async def show_delete_page(callback: CallbackQuery, page: int) -> bool:
+    """Перерисовка страницы списка удаления в текущем режиме; False при ошибке загрузки"""
+    selection = sessions.get(callback.from_user.id, "delete_selection")
+    keyboard, total = await get_torrents_keyboard(page=page, selection=selection)
+
+    if keyboard is None:
+        return False
+
+    await edit_message_if_changed(
+        callback.message,
+        get_delete_list_text(page, total, selection),
+        reply_markup=keyboard,
+        parse_mode="Markdown"
+    )
+    return True
+
+def select_torrents_by_filter(name: str) -> set:
+    """ID торрентов снимка, подходящих под фильтр массового удаления"""
+    if name == "errors":
+        return {t.id for t in torrent_snapshot.torrents if t.error != 0 or t.error_string}
+
+    cutoff = time.time() - DELETE_SEED_DAYS * 86400
+    return {
+        t.id for t in torrent_snapshot.torrents
+        if t.status in SEEDING_STATUSES and (t.done_date or t.added_date) < cutoff
+    }
+
+def get_bulk_delete_confirmation_keyboard():
+    """Клавиатура подтверждения массового удаления"""
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🗑 Удалить с файлами", callback_data="bulk_delete_with_files")],
+        [InlineKeyboardButton(text="📋 Удалить без файлов", callback_data="bulk_delete_no_files")],
+        [InlineKeyboardButton(text="❌ Отмена", callback_data="cancel_delete")]
+    ])
+
+# Строка торрента в списках
+def format_torrent_line(torrent) -> str:
+    """Торрент в списке: статус, имя, прогресс, размер и ошибка"""
+    progress = torrent.progress
+    status = get_status_emoji(torrent.status)
+    size = format_size(torrent.total_size)
+
+    name = escape_markdown(torrent.name)
+    name = name[:50] + '...' if len(name) > 50 else name
+
+    error_text = ""
+    if torrent.error_string:
+        error_text = f"\n   ⚠️ Ошибка: {escape_markdown(torrent.error_string)}"
+
+    return (
+        f"{status} `{name}`\n"
+        f"   📊 Прогресс: *{progress:.1f}%* | 📦 Размер: *{size}*{error_text}\n\n"
+    )
+
 # Формирование страницы списка торрентов с пагинацией
-def get_torrents_list_page(page=0, per_page=MAX_TORRENTS_DISPLAY):
+async def get_torrents_list_page(page=0, per_page=MAX_TORRENTS_DISPLAY):
     """Текст списка торрентов и inline-клавиатура для навигации"""
-    torrents = client.get_torrents()
-    if not torrents:
+    await torrent_snapshot.ensure_fresh()
+    version = torrent_snapshot.version
+    cache_key = ("list", page, per_page, version)
+    cached = rendered_pages.get(cache_key)
+    if cached is not None:
+        return cached
+
+    total = len(torrent_snapshot.order)
+    if total == 0:
         return None, None
 
-    torrents = sort_torrents(torrents)
-    total = len(torrents)
     max_page = max(0, (total - 1) // per_page)
     page = min(max(page, 0), max_page)
 
-    page_torrents, _, _, _ = paginate_torrents(torrents, page=page, per_page=per_page)
+    page_torrents, _, _, _ = paginate_torrents(torrent_snapshot, page=page, per_page=per_page)
     total_pages = max_page + 1
 
     response = f"📋 *Активные торренты* (страница {page + 1} из {total_pages}):\n\n"
 
     for torrent in page_torrents:
-        progress = torrent.progress
-        status = get_status_emoji(torrent.status)
-        size = format_size(torrent.total_size)
-
-        name = escape_markdown(torrent.name)
-        name = name[:50] + '...' if len(name) > 50 else name
-
-        error_text = ""
-        if hasattr(torrent, 'error_string') and torrent.error_string:
-            error_text = f"\n   ⚠️ Ошибка: {escape_markdown(torrent.error_string)}"
-
-        response += f"{status} `{name}`\n"
-        response += f"   📊 Прогресс: *{progress:.1f}%* | 📦 Размер: *{size}*{error_text}\n\n"
+        response += format_torrent_line(torrent)
 
     nav_buttons = get_pagination_buttons(page, total, per_page, "list_page_")
     keyboard = InlineKeyboardMarkup(inline_keyboard=[nav_buttons]) if nav_buttons else None
 
+    rendered_pages.put(cache_key, (response, keyboard), version)
     return response, keyboard
 
 # Клавиатура подтверждения удаления
@@ -369,15 +1774,22 @@ async def cmd_help(message: Message):
         "1️⃣ Отправьте magnet-ссылку или .torrent файл\n"
         "2️⃣ Выберите категорию (Movies, Series, Music, Other)\n"
         "3️⃣ Торрент начнет загружаться\n\n"
+        "📦 Можно отправить сразу несколько magnet-ссылок (по одной в строке), "
+        "альбом .torrent файлов или .zip архив с ними - категория выбирается один раз\n\n"
         "*Управление:*\n"
         "📋 *Список торрентов* - отсортированный список\n"
         "   • Сначала загружающиеся\n"
         "   • Затем с ошибками\n"
         "   • Потом готовые\n"
         "📊 *Статус* - информация о системе\n"
-        "🗑 *Удалить торрент* - выбор торрента для удаления\n\n"
+        "📈 /stats - графики скоростей, активных торрентов и свободного места\n"
+        "🗑 *Удалить торрент* - выбор торрента для удаления\n"
+        "   • ☑️ Можно отметить несколько или выбрать по фильтру\n"
+        "🔍 /find <текст> - поиск торрента по имени\n"
+        "   • Или в любом чате: @имя\\_бота <текст>\n\n"
         "*Уведомления:*\n"
-        "🔔 Получите уведомление когда загрузка завершится"
+        "🔔 Получите уведомление когда загрузка завершится\n"
+        "📡 Кнопка *Следить за загрузкой* показывает прогресс, скорость и оставшееся время"
     )
 
     await message.answer(help_text, reply_markup=get_main_keyboard(), parse_mode="Markdown")
@@ -390,14 +1802,15 @@ async def cmd_list(message: Message):
         return
 
     try:
-        response, keyboard = get_torrents_list_page(page=0, per_page=MAX_TORRENTS_DISPLAY)
+        response, keyboard = await get_torrents_list_page(page=0, per_page=MAX_TORRENTS_DISPLAY)
 
         if response is None:
             empty_message = os.getenv("EMPTY_LIST_MESSAGE", "📭 Список торрентов пуст")
             await message.answer(empty_message, reply_markup=get_main_keyboard())
             return
 
-        await message.answer(response, reply_markup=keyboard, parse_mode="Markdown")
+        sent = await message.answer(response, reply_markup=keyboard, parse_mode="Markdown")
+        shown_messages.remember(sent, ShownMessages.digest(response, keyboard))
     except Exception as e:
         await message.answer(f"{EMOJI_ERROR} Ошибка: {str(e)}", reply_markup=get_main_keyboard())
 
@@ -409,15 +1822,18 @@ async def handle_list_page(callback: CallbackQuery):
 
     try:
         page = int(callback.data.replace("list_page_", ""))
-        response, keyboard = get_torrents_list_page(page=page, per_page=MAX_TORRENTS_DISPLAY)
 
-        if response is None:
-            await callback.message.edit_text("📭 Список торрентов пуст")
-            await callback.answer()
-            return
+        async def render():
+            response, keyboard = await get_torrents_list_page(page=page, per_page=MAX_TORRENTS_DISPLAY)
+            if response is None:
+                await edit_message_if_changed(callback.message, "📭 Список торрентов пуст")
+            else:
+                await edit_message_if_changed(callback.message, response, reply_markup=keyboard, parse_mode="Markdown")
+            return True
 
-        await callback.message.edit_text(response, reply_markup=keyboard, parse_mode="Markdown")
-        await callback.answer()
+        # Быстрые повторные нажатия: рисуем только последнее
+        if await pagination_callbacks.run(callback, render):
+            await callback.answer()
     except Exception as e:
         await callback.answer(f"❌ Ошибка: {str(e)}", show_alert=True)
 
@@ -429,33 +1845,51 @@ async def cmd_status(message: Message):
         return
 
     try:
-        session = client.get_session()
-        torrents = client.get_torrents()
+        response, keyboard = await get_status_message()
+        await message.answer(response, reply_markup=keyboard, parse_mode="Markdown")
+    except Exception as e:
+        await message.answer(f"{EMOJI_ERROR} Ошибка: {str(e)}", reply_markup=get_main_keyboard())
 
-        active, seeding, paused, errors, total = get_status_counts(torrents)
+@dp.callback_query(F.data == "status_details")
+async def handle_status_details(callback: CallbackQuery):
+    """Подробная разбивка статуса по торрентам"""
+    if not check_access(callback.from_user.id):
+        return
 
-        download_speed = sum(t.rate_download for t in torrents)
-        upload_speed = sum(t.rate_upload for t in torrents)
+    try:
+        response, keyboard = await get_status_message(breakdown=True)
+        await callback.message.edit_text(response, reply_markup=keyboard, parse_mode="Markdown")
+        await callback.answer()
+    except Exception as e:
+        await callback.answer(f"❌ Ошибка: {str(e)}", show_alert=True)
 
-        response = (
-            "📊 *Transmission Master Bot - Статус:*\n\n"
-            f"🔄 Загружается: *{active}*\n"
-            f"✅ Раздается: *{seeding}*\n"
-            f"⏸️ Остановлено: *{paused}*\n"
-        )
+@dp.message(Command("stats"))
+async def cmd_stats(message: Message):
+    """Команда /stats - история скоростей и активности"""
+    if not check_access(message.from_user.id):
+        return
 
-        if errors > 0:
-            response += f"❌ С ошибками: *{errors}*\n"
+    text, keyboard = render_stats_message("minute")
+    sent = await message.answer(text, reply_markup=keyboard, parse_mode="Markdown")
+    shown_messages.remember(sent, ShownMessages.digest(text, keyboard))
 
-        response += (
-            f"📦 Всего: *{total}*\n\n"
-            f"⬇️ Скорость загрузки: *{format_size(download_speed)}/s*\n"
-            f"⬆️ Скорость отдачи: *{format_size(upload_speed)}/s*\n\n"
-        )
+@dp.callback_query(F.data.startswith("stats_"))
+async def handle_stats(callback: CallbackQuery):
+    """Переключение периода истории (повторное нажатие обновляет график)"""
+    if not check_access(callback.from_user.id):
+        return
 
-        await message.answer(response, reply_markup=get_main_keyboard(), parse_mode="Markdown")
+    resolution = callback.data.replace("stats_", "")
+    if resolution not in activity_history.buffers:
+        await callback.answer()
+        return
+
+    try:
+        text, keyboard = render_stats_message(resolution)
+        await edit_message_if_changed(callback.message, text, reply_markup=keyboard, parse_mode="Markdown")
+        await callback.answer()
     except Exception as e:
-        await message.answer(f"{EMOJI_ERROR} Ошибка: {str(e)}", reply_markup=get_main_keyboard())
+        await callback.answer(f"❌ Ошибка: {str(e)}", show_alert=True)
 
 @dp.message(F.text == "🗑 Удалить торрент")
 async def cmd_delete(message: Message, state: FSMContext):
@@ -463,10 +1897,11 @@ async def cmd_delete(message: Message, state: FSMContext):
     if not check_access(message.from_user.id):
         return
 
-    # Инициализируем страницу
-    delete_page[message.from_user.id] = 0
+    # Инициализируем страницу и сбрасываем множественный выбор
+    sessions.set(message.from_user.id, "delete_page", 0)
+    sessions.pop(message.from_user.id, "delete_selection")
 
-    keyboard, total = get_torrents_keyboard(page=0)
+    keyboard, total = await get_torrents_keyboard(page=0)
 
     if keyboard is None or total == 0:
         await message.answer("📭 Список торрентов пуст", reply_markup=get_main_keyboard())
@@ -488,20 +1923,15 @@ async def handle_delete_page(callback: CallbackQuery, state: FSMContext):
 
     try:
         page = int(callback.data.replace("delete_page_", ""))
-        delete_page[callback.from_user.id] = page
+        sessions.set(callback.from_user.id, "delete_page", page)
 
-        keyboard, total = get_torrents_keyboard(page=page)
-
-        if keyboard is None:
+        shown = await pagination_callbacks.run(callback, lambda: show_delete_page(callback, page))
+        if shown is None:
+            return
+        if not shown:
             await callback.answer("❌ Ошибка загрузки списка")
             return
 
-        await callback.message.edit_text(
-            f"🗑 *Выберите торрент для удаления:*\n_Страница {page + 1}, всего торрентов: {total}_",
-            reply_markup=keyboard,
-            parse_mode="Markdown"
-        )
-
         await callback.answer()
     except Exception as e:
         await callback.answer(f"❌ Ошибка: {str(e)}", show_alert=True)
@@ -515,10 +1945,12 @@ async def handle_delete_select(callback: CallbackQuery, state: FSMContext):
     try:
         torrent_id = int(callback.data.replace("delete_select_", ""))
 
-        torrent = client.get_torrent(torrent_id)
+        torrent = torrent_snapshot.get_torrent(torrent_id)
+        if torrent is None:
+            torrent = await rpc_call("get_torrent", torrent_id, arguments=DELETE_DETAIL_FIELDS, convert=to_record)
 
         # Сохраняем выбранный торрент
-        user_selected_torrents[callback.from_user.id] = torrent_id
+        sessions.set(callback.from_user.id, "selected_torrent", torrent_id)
 
         name = torrent.name
         size = format_size(torrent.total_size)
@@ -555,15 +1987,17 @@ async def handle_delete_confirm(callback: CallbackQuery, state: FSMContext):
         delete_files = parts[2] == "with"
         torrent_id = int(parts[-1])
 
-        torrent = client.get_torrent(torrent_id)
+        torrent = torrent_snapshot.get_torrent(torrent_id)
+        if torrent is None:
+            torrent = await rpc_call("get_torrent", torrent_id, arguments=["id", "name"], convert=to_record)
         name = torrent.name
 
         # Удаляем торрент
-        client.remove_torrent(torrent_id, delete_data=delete_files)
+        await rpc_call("remove_torrent", torrent_id, delete_data=delete_files)
+        torrent_snapshot.invalidate()
 
-        # Удаляем из кеша
-        if callback.from_user.id in user_selected_torrents:
-            del user_selected_torrents[callback.from_user.id]
+        # Удаляем из сессии
+        sessions.pop(callback.from_user.id, "selected_torrent")
 
         action = "с файлами" if delete_files else "без файлов"
         success_text = (
@@ -586,23 +2020,665 @@ async def handle_cancel_delete(callback: CallbackQuery, state: FSMContext):
     if not check_access(callback.from_user.id):
         return
 
-    if callback.from_user.id in user_selected_torrents:
-        del user_selected_torrents[callback.from_user.id]
+    sessions.pop(callback.from_user.id, "selected_torrent")
+    sessions.pop(callback.from_user.id, "delete_selection")
 
     await callback.message.edit_text("❌ Удаление отменено")
     await callback.message.answer("Что дальше?", reply_markup=get_main_keyboard())
     await callback.answer("Отменено")
     await state.clear()
 
-@dp.message(F.text.startswith("magnet:"))
+@dp.callback_query(F.data == "delete_multi")
+async def handle_delete_multi(callback: CallbackQuery, state: FSMContext):
+    """Переход в режим множественного выбора торрентов для удаления"""
+    if not check_access(callback.from_user.id):
+        return
+
+    try:
+        sessions.set(callback.from_user.id, "delete_selection", set())
+        await show_delete_page(callback, sessions.get(callback.from_user.id, "delete_page", 0))
+        await callback.answer("Отметьте торренты для удаления")
+    except Exception as e:
+        await callback.answer(f"❌ Ошибка: {str(e)}", show_alert=True)
+
+@dp.callback_query(F.data.startswith("delete_toggle_"))
+async def handle_delete_toggle(callback: CallbackQuery, state: FSMContext):
+    """Отметка торрента в режиме множественного выбора"""
+    if not check_access(callback.from_user.id):
+        return
+
+    try:
+        torrent_id = int(callback.data.replace("delete_toggle_", ""))
+        selection = sessions.get(callback.from_user.id, "delete_selection", set())
+        selection.symmetric_difference_update({torrent_id})
+        sessions.set(callback.from_user.id, "delete_selection", selection)
+
+        await show_delete_page(callback, sessions.get(callback.from_user.id, "delete_page", 0))
+        await callback.answer()
+    except Exception as e:
+        await callback.answer(f"❌ Ошибка: {str(e)}", show_alert=True)
+
+@dp.callback_query(F.data.startswith("delete_filter_"))
+async def handle_delete_filter(callback: CallbackQuery, state: FSMContext):
+    """Отметка всех торрентов, подходящих под фильтр"""
+    if not check_access(callback.from_user.id):
+        return
+
+    try:
+        await torrent_snapshot.ensure_fresh()
+        matched = select_torrents_by_filter(callback.data.replace("delete_filter_", ""))
+        selection = sessions.get(callback.from_user.id, "delete_selection", set())
+        added = len(matched - selection)
+        selection |= matched
+        sessions.set(callback.from_user.id, "delete_selection", selection)
+
+        await show_delete_page(callback, sessions.get(callback.from_user.id, "delete_page", 0))
+        await callback.answer(f"Отмечено еще: {added}")
+    except Exception as e:
+        await callback.answer(f"❌ Ошибка: {str(e)}", show_alert=True)
+
+@dp.callback_query(F.data == "delete_clear")
+async def handle_delete_clear(callback: CallbackQuery, state: FSMContext):
+    """Сброс множественного выбора"""
+    if not check_access(callback.from_user.id):
+        return
+
+    try:
+        sessions.set(callback.from_user.id, "delete_selection", set())
+        await show_delete_page(callback, sessions.get(callback.from_user.id, "delete_page", 0))
+        await callback.answer("Выбор сброшен")
+    except Exception as e:
+        await callback.answer(f"❌ Ошибка: {str(e)}", show_alert=True)
+
+@dp.callback_query(F.data == "delete_bulk")
+async def handle_delete_bulk(callback: CallbackQuery, state: FSMContext):
+    """Подтверждение удаления отмеченных торрентов"""
+    if not check_access(callback.from_user.id):
+        return
+
+    selection = sessions.get(callback.from_user.id, "delete_selection")
+    if not selection:
+        await callback.answer("Ничего не выбрано", show_alert=True)
+        return
+
+    lines = []
+    for torrent_id in sorted(selection)[:20]:
+        torrent = torrent_snapshot.get_torrent(torrent_id)
+        lines.append(f"📝 {escape_markdown(torrent.name if torrent else f'ID {torrent_id}')}\n")
+    if len(selection) > 20:
+        lines.append(f"_...и еще {len(selection) - 20}_\n")
+
+    await callback.message.edit_text(
+        f"🗑 *Удаление торрентов: {len(selection)}*\n\n" + "".join(lines) + "\nВыберите способ удаления:",
+        reply_markup=get_bulk_delete_confirmation_keyboard(),
+        parse_mode="Markdown"
+    )
+    await state.set_state(TorrentStates.confirming_deletion)
+    await callback.answer()
+
+@dp.callback_query(F.data.startswith("bulk_delete_"))
+async def handle_bulk_delete_confirm(callback: CallbackQuery, state: FSMContext):
+    """Удаление отмеченных торрентов одним RPC-запросом"""
+    if not check_access(callback.from_user.id):
+        return
+
+    try:
+        delete_files = callback.data == "bulk_delete_with_files"
+        selection = sessions.pop(callback.from_user.id, "delete_selection")
+        if not selection:
+            await callback.answer("Ничего не выбрано", show_alert=True)
+            return
+
+        await rpc_call("remove_torrent", sorted(selection), delete_data=delete_files)
+        torrent_snapshot.invalidate()
+
+        action = "с файлами" if delete_files else "без файлов"
+        await callback.message.edit_text(f"✅ *Удалено торрентов {action}: {len(selection)}*", parse_mode="Markdown")
+        await callback.message.answer("Что дальше?", reply_markup=get_main_keyboard())
+        await callback.answer(f"✅ Удалено {action}")
+
+    except Exception as e:
+        await callback.answer(f"❌ Ошибка: {str(e)}", show_alert=True)
+
+    await state.clear()
+
+# Поиск торрентов и карточка торрента
+CARD_FIELDS = ["id", "name", "status", "percentDone", "totalSize", "error", "errorString"]
+
+def get_torrent_card(torrent, inline: bool = False):
+    """Текст карточки торрента и кнопки действий (в inline-сообщениях без удаления)"""
+    text = (
+        f"{get_status_emoji(torrent.status)} `{escape_markdown(torrent.name)}`\n\n"
+        f"📊 Прогресс: *{torrent.progress:.1f}%*\n"
+        f"📦 Размер: *{format_size(torrent.total_size)}*\n"
+        f"🆔 ID: `{torrent.id}`"
+    )
+    if torrent.error_string:
+        text += f"\n⚠️ Ошибка: {escape_markdown(torrent.error_string)}"
+
+    if torrent.status == "stopped":
+        toggle = InlineKeyboardButton(text="▶️ Запустить", callback_data=f"card_start_{torrent.id}")
+    else:
+        toggle = InlineKeyboardButton(text="⏸️ Остановить", callback_data=f"card_stop_{torrent.id}")
+    buttons = [[toggle, InlineKeyboardButton(text="🔄 Обновить", callback_data=f"card_{torrent.id}")]]
+    if not inline:
+        if torrent.progress < 100:
+            buttons.append([InlineKeyboardButton(text="📡 Следить за загрузкой", callback_data=f"track_{torrent.id}")])
+        buttons.append([
+            InlineKeyboardButton(text="📂 Файлы", callback_data=f"files_{torrent.id}"),
+            InlineKeyboardButton(text="🗑 Удалить", callback_data=f"delete_select_{torrent.id}")
+        ])
+
+    return text, InlineKeyboardMarkup(inline_keyboard=buttons)
+
+async def edit_callback_message(callback: CallbackQuery, text: str, **kwargs) -> None:
+    """Редактирование сообщения с кнопкой: обычного или отправленного через inline-режим"""
+    if callback.message is not None:
+        await callback.message.edit_text(text, **kwargs)
+    else:
+        await bot.edit_message_text(text, inline_message_id=callback.inline_message_id, **kwargs)
+
+@dp.message(Command("find"))
+async def cmd_find(message: Message, command: CommandObject):
+    """Команда /find - поиск торрентов по имени"""
+    if not check_access(message.from_user.id):
+        return
+
+    query = (command.args or "").strip()
+    if not query:
+        await message.answer("🔍 Укажите часть имени: `/find ubuntu 24.04`", parse_mode="Markdown")
+        return
+
+    try:
+        await torrent_snapshot.ensure_loaded()
+        torrents = await torrent_snapshot.search(query, FIND_RESULTS_LIMIT)
+    except Exception as e:
+        await message.answer(f"{EMOJI_ERROR} Ошибка: {str(e)}", reply_markup=get_main_keyboard())
+        return
+
+    if not torrents:
+        await message.answer(f"🔍 Ничего не найдено: `{escape_markdown(query)}`", parse_mode="Markdown")
+        return
+
+    response = f"🔍 *Найдено по запросу* `{escape_markdown(query)}`:\n\n"
+    buttons = []
+    for torrent in torrents:
+        response += format_torrent_line(torrent)
+        name = torrent.name[:40] + "..." if len(torrent.name) > 40 else torrent.name
+        buttons.append([InlineKeyboardButton(
+            text=f"{get_status_emoji(torrent.status)} {name}",
+            callback_data=f"card_{torrent.id}"
+        )])
+
+    await message.answer(
+        response,
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons),
+        parse_mode="Markdown"
+    )
+
+@dp.inline_query()
+async def handle_inline_query(inline_query: InlineQuery):
+    """Inline-режим: поиск торрентов по мере ввода"""
+    if not check_access(inline_query.from_user.id):
+        await inline_query.answer([], cache_time=60, is_personal=True)
+        return
+
+    try:
+        await torrent_snapshot.ensure_loaded()
+        query = inline_query.query.strip()
+        if query:
+            torrents = await torrent_snapshot.search(query, INLINE_RESULTS_LIMIT)
+        else:
+            torrents = torrent_snapshot.get_sorted(0, INLINE_RESULTS_LIMIT)
+    except Exception as e:
+        # Transmission недоступен: пустой ответ, чтобы клиент не ждал результатов
+        print(f"Ошибка inline-поиска: {e}")
+        await inline_query.answer([], cache_time=0, is_personal=True)
+        return
+
+    results = []
+    for torrent in torrents:
+        text, keyboard = get_torrent_card(torrent, inline=True)
+        results.append(InlineQueryResultArticle(
+            id=str(torrent.id),
+            title=f"{get_status_emoji(torrent.status)} {torrent.name}",
+            description=f"{torrent.progress:.1f}% | {format_size(torrent.total_size)}",
+            input_message_content=InputTextMessageContent(message_text=text, parse_mode="Markdown"),
+            reply_markup=keyboard
+        ))
+
+    await inline_query.answer(results, cache_time=5, is_personal=True)
+
+@dp.callback_query(F.data.regexp(r"^card_(start_|stop_)?\d+$"))
+async def handle_torrent_card(callback: CallbackQuery):
+    """Карточка торрента: показ, обновление, запуск и остановка"""
+    if not check_access(callback.from_user.id):
+        return
+
+    try:
+        action, _, torrent_id = callback.data.removeprefix("card_").rpartition("_")
+        torrent_id = int(torrent_id)
+
+        if action == "start":
+            await rpc_call("start_torrent", torrent_id)
+            torrent_snapshot.invalidate()
+            monitor_wakeup.set()
+        elif action == "stop":
+            await rpc_call("stop_torrent", torrent_id)
+            torrent_snapshot.invalidate()
+
+        torrent = await rpc_call("get_torrent", torrent_id, arguments=CARD_FIELDS, convert=to_record)
+        text, keyboard = get_torrent_card(torrent, inline=callback.message is None)
+
+        try:
+            await edit_callback_message(callback, text, reply_markup=keyboard, parse_mode="Markdown")
+        except TelegramBadRequest as e:
+            # Повторное нажатие "Обновить" без изменений
+            if "message is not modified" not in str(e):
+                raise
+
+        notices = {"start": "▶️ Запущен", "stop": "⏸️ Остановлен"}
+        await callback.answer(notices.get(action))
+    except KeyError:
+        await callback.answer("❌ Торрент не найден", show_alert=True)
+    except Exception as e:
+        await callback.answer(f"❌ Ошибка: {str(e)}", show_alert=True)
+
+@dp.callback_query(F.data.startswith("track_"))
+async def handle_track(callback: CallbackQuery):
+    """Превращение сообщения в живой прогресс загрузки"""
+    if not check_access(callback.from_user.id):
+        return
+
+    if callback.message is None:
+        await callback.answer("Отслеживание доступно только в чате с ботом", show_alert=True)
+        return
+
+    try:
+        torrent_id = int(callback.data.replace("track_", ""))
+        torrent = await rpc_call("get_torrent", torrent_id, arguments=TRACK_FIELDS, convert=to_record)
+
+        chat_id, message_id = callback.message.chat.id, callback.message.message_id
+        if not progress_tracker.track(chat_id, message_id, torrent_id):
+            await callback.answer(f"❌ Отслеживается уже {TRACK_MAX_MESSAGES} сообщений", show_alert=True)
+            return
+
+        text, keyboard, finished = render_tracking_message(torrent)
+        await callback.message.edit_text(text, reply_markup=keyboard, parse_mode="Markdown")
+        progress_tracker.shown(chat_id, message_id, text, finished)
+
+        # Мониторинг мог уснуть надолго - пересчитываем интервал с учетом отслеживания
+        monitor_wakeup.set()
+        await callback.answer("📡 Прогресс будет обновляться")
+    except KeyError:
+        await callback.answer("❌ Торрент не найден", show_alert=True)
+    except Exception as e:
+        await callback.answer(f"❌ Ошибка: {str(e)}", show_alert=True)
+
+@dp.callback_query(F.data.startswith("untrack_"))
+async def handle_untrack(callback: CallbackQuery):
+    """Остановка живого прогресса"""
+    if not check_access(callback.from_user.id):
+        return
+
+    progress_tracker.untrack(callback.message.chat.id, callback.message.message_id)
+    await callback.message.edit_reply_markup(reply_markup=None)
+    await callback.answer("⏹ Отслеживание остановлено")
+
+# Выбор файлов торрента
+FILE_PRIORITY_MARKS = {1: "🔺", 0: "", -1: "🔻"}
+# Нажатие на имя файла переключает приоритет по кругу
+NEXT_FILE_PRIORITY = {0: 1, 1: -1, -1: 0}
+
+def to_file_list(torrent) -> dict:
+    """Файлы торрента, отсортированные по пути (выполняется в потоке пула)"""
+    files = torrent.fields.get("files", [])
+    stats = torrent.fields.get("fileStats", [])
+    order = sorted(range(len(files)), key=lambda i: files[i]["name"])
+    return {
+        "torrent_id": torrent.fields["id"],
+        "name": torrent.fields.get("name", ""),
+        "paths": [files[i]["name"] for i in order],
+        "sizes": array("q", (files[i]["length"] for i in order)),
+        # Номер файла в торренте для change_torrent
+        "indices": array("l", order),
+        "wanted": bytearray(bool(stats[i]["wanted"]) for i in order),
+        "priorities": array("b", (stats[i]["priority"] for i in order)),
+    }
+
+class FileTree:
+    """Дерево папок поверх отсортированного списка путей: узлы строятся только для раскрытых папок"""
+
+    def __init__(self, files: dict, selection: dict):
+        self.paths = files["paths"]
+        self.expanded = selection["expanded"]
+
+    def span(self, path: str) -> tuple:
+        """Диапазон позиций файлов внутри папки ("" - корень)"""
+        if not path:
+            return 0, len(self.paths)
+        prefix = path + "/"
+        return bisect.bisect_left(self.paths, prefix), bisect.bisect_left(self.paths, prefix + "\U0010ffff")
+
+    def children(self, path: str) -> list:
+        """Непосредственное содержимое папки: (папка?, путь, имя, начало, конец)"""
+        start, end = self.span(path)
+        skip = len(path) + 1 if path else 0
+        nodes = []
+        position = start
+        while position < end:
+            name, separator, _ = self.paths[position][skip:].partition("/")
+            if separator:
+                child = f"{path}/{name}" if path else name
+                child_start, child_end = self.span(child)
+                nodes.append((True, child, name, child_start, child_end))
+                # Вложенные файлы папки пропускаем целиком
+                position = child_end
+            else:
+                nodes.append((False, self.paths[position], name, position, position + 1))
+                position += 1
+        return nodes
+
+    def rows(self) -> list:
+        """Видимые строки (глубина, узел): содержимое раскрытой папки идет сразу за ней"""
+        rows = []
+        stack = [(0, node) for node in reversed(self.children(""))]
+        while stack:
+            depth, node = stack.pop()
+            rows.append((depth, node))
+            if node[0] and node[1] in self.expanded:
+                stack.extend((depth + 1, child) for child in reversed(self.children(node[1])))
+        return rows
+
+def shorten_name(name: str, max_length: int = FILE_NAME_MAX_LENGTH) -> str:
+    """Обрезка длинного имени для кнопки"""
+    return name if len(name) <= max_length else name[:max_length - 1] + "…"
+
+def render_file_selection(files: dict, selection: dict):
+    """Текст и клавиатура страницы дерева файлов"""
+    torrent_id = files["torrent_id"]
+    sizes, wanted, priorities = files["sizes"], selection["wanted"], selection["priorities"]
+    rows = FileTree(files, selection).rows()
+    pages = max(1, (len(rows) + FILES_PAGE_SIZE - 1) // FILES_PAGE_SIZE)
+    page = selection["page"] = min(selection["page"], pages - 1)
+
+    wanted_size = sum(size for size, is_wanted in zip(sizes, wanted) if is_wanted)
+    text = (
+        f"📂 *Выбор файлов*\n`{escape_markdown(files['name'])}`\n\n"
+        f"Выбрано файлов: *{wanted.count(1)}* из *{len(wanted)}* "
+        f"({format_size(wanted_size)} из {format_size(sum(sizes))})\n\n"
+        "✅/⬜ - скачивать или нет, нажатие на папку раскрывает ее, на файл - меняет приоритет (🔺/🔻)"
+    )
+    if pages > 1:
+        text += f"\n\n📄 Страница {page + 1} из {pages}"
+
+    buttons = []
+    for row in range(page * FILES_PAGE_SIZE, min(len(rows), (page + 1) * FILES_PAGE_SIZE)):
+        depth, (is_dir, path, name, start, end) = rows[row]
+        selected = wanted[start:end].count(1)
+        mark = "✅" if selected == end - start else ("⬜" if not selected else "◻️")
+        if is_dir:
+            arrow = "▼" if path in selection["expanded"] else "▶"
+            label = f"{'· ' * depth}{arrow} 📁 {shorten_name(name)} · {format_size(sum(sizes[start:end]))}"
+        else:
+            label = f"{'· ' * depth}{FILE_PRIORITY_MARKS[priorities[start]]}📄 {shorten_name(name)} · {format_size(sizes[start])}"
+        buttons.append([
+            InlineKeyboardButton(text=mark, callback_data=f"fs_{torrent_id}_t_{row}"),
+            InlineKeyboardButton(text=label, callback_data=f"fs_{torrent_id}_o_{row}")
+        ])
+
+    navigation = get_pagination_buttons(page, len(rows), FILES_PAGE_SIZE, f"fs_{torrent_id}_p_")
+    if navigation:
+        buttons.append(navigation)
+
+    buttons.append([
+        InlineKeyboardButton(text="✅ Все", callback_data=f"fs_{torrent_id}_all"),
+        InlineKeyboardButton(text="⬜ Ничего", callback_data=f"fs_{torrent_id}_none")
+    ])
+    buttons.append([
+        InlineKeyboardButton(text="💾 Применить", callback_data=f"fs_{torrent_id}_apply"),
+        InlineKeyboardButton(text="✖️ Отмена", callback_data=f"fs_{torrent_id}_cancel")
+    ])
+    return text, InlineKeyboardMarkup(inline_keyboard=buttons)
+
+def get_file_changes(files: dict, selection: dict) -> dict:
+    """Аргументы change_torrent для отличий выбора от текущего состояния торрента"""
+    changes = {}
+    indices = files["indices"]
+    for position, (was_wanted, is_wanted) in enumerate(zip(files["wanted"], selection["wanted"])):
+        if was_wanted != is_wanted:
+            changes.setdefault("files_wanted" if is_wanted else "files_unwanted", []).append(indices[position])
+    names = {1: "priority_high", 0: "priority_normal", -1: "priority_low"}
+    for position, (old, new) in enumerate(zip(files["priorities"], selection["priorities"])):
+        if old != new:
+            changes.setdefault(names[new], []).append(indices[position])
+    return changes
+
+async def open_file_selection(message: Message, user_id: int, torrent_id: int, start_on_finish: bool = False) -> bool:
+    """Загрузка списка файлов одного торрента и отправка дерева; False - метаданных еще нет"""
+    files = await rpc_call("get_torrent", torrent_id, arguments=FILE_FIELDS, convert=to_file_list)
+    if not files["paths"]:
+        return False
+
+    selection = {
+        "torrent_id": torrent_id,
+        "wanted": bytearray(files["wanted"]),
+        "priorities": array("b", files["priorities"]),
+        "expanded": set(),
+        "page": 0,
+        # Торрент добавлен на паузе - запускаем после применения или отмены выбора
+        "start_on_finish": start_on_finish,
+    }
+    # Единственную корневую папку (обычно имя раздачи) сразу раскрываем
+    roots = FileTree(files, selection).children("")
+    if len(roots) == 1 and roots[0][0]:
+        selection["expanded"].add(roots[0][1])
+
+    text, keyboard = render_file_selection(files, selection)
+    # Список файлов может быть большим - держим его только в памяти, в SQLite пишем лишь отметки
+    pending_uploads.set(user_id, "file_list", files, ttl=SESSION_TTL)
+    sessions.set(user_id, "file_selection", selection)
+    await message.answer(text, reply_markup=keyboard, parse_mode="Markdown")
+    return True
+
+@dp.callback_query(F.data.regexp(r"^files_\d+$"))
+async def handle_files(callback: CallbackQuery):
+    """Открытие выбора файлов торрента (новым сообщением)"""
+    if not check_access(callback.from_user.id):
+        return
+
+    try:
+        torrent_id = int(callback.data.replace("files_", ""))
+        if not await open_file_selection(callback.message, callback.from_user.id, torrent_id):
+            await callback.answer("⏳ Список файлов еще не получен (magnet загружает метаданные), попробуйте позже", show_alert=True)
+            return
+        await callback.answer()
+    except KeyError:
+        await callback.answer("❌ Торрент не найден", show_alert=True)
+    except Exception as e:
+        await callback.answer(f"❌ Ошибка: {str(e)}", show_alert=True)
+
+async def finish_file_selection(user_id: int, selection: dict) -> bool:
+    """Сброс сессии выбора и запуск торрента, добавленного на паузе; True - торрент запущен"""
+    pending_uploads.pop(user_id, "file_list")
+    sessions.pop(user_id, "file_selection")
+    if not selection.get("start_on_finish"):
+        return False
+    await rpc_call("start_torrent", selection["torrent_id"])
+    torrent_snapshot.invalidate()
+    monitor_wakeup.set()
+    return True
+
+@dp.callback_query(F.data.startswith("fs_"))
+async def handle_file_selection(callback: CallbackQuery):
+    """Отметка файлов и папок, раскрытие папок, приоритеты и применение выбора"""
+    if not check_access(callback.from_user.id):
+        return
+
+    user_id = callback.from_user.id
+    _, torrent_id, action, *argument = callback.data.split("_")
+    files = pending_uploads.get(user_id, "file_list")
+    selection = sessions.get(user_id, "file_selection")
+    if files is None or selection is None or selection["torrent_id"] != int(torrent_id):
+        await callback.answer("⌛ Выбор файлов устарел, откройте его заново", show_alert=True)
+        return
+
+    wanted = selection["wanted"]
+    if action == "cancel":
+        try:
+            started = await finish_file_selection(user_id, selection)
+        except Exception as e:
+            await callback.answer(f"❌ Ошибка: {str(e)}", show_alert=True)
+            return
+        await callback.message.edit_text(
+            "❌ Выбор файлов отменен" + (", торрент запущен целиком" if started else "")
+        )
+        await callback.answer()
+        return
+
+    if action == "apply":
+        if not wanted.count(1):
+            await callback.answer("❌ Выберите хотя бы один файл", show_alert=True)
+            return
+        changes = get_file_changes(files, selection)
+        try:
+            if changes:
+                # Отметки и приоритеты всех файлов - одним запросом torrent-set
+                await rpc_call("change_torrent", selection["torrent_id"], **changes)
+                torrent_snapshot.invalidate()
+                monitor_wakeup.set()
+            await finish_file_selection(user_id, selection)
+        except Exception as e:
+            await callback.answer(f"❌ Ошибка: {str(e)}", show_alert=True)
+            return
+        wanted_size = sum(size for size, is_wanted in zip(files["sizes"], wanted) if is_wanted)
+        await callback.message.edit_text(
+            f"✅ Выбор файлов сохранен\n`{escape_markdown(files['name'])}`\n\n"
+            f"Файлов: *{wanted.count(1)}* из *{len(wanted)}*, {format_size(wanted_size)}",
+            parse_mode="Markdown"
+        )
+        await callback.answer("✅ Применено" if changes else "Без изменений")
+        return
+
+    if action == "all":
+        wanted[:] = b"\x01" * len(wanted)
+    elif action == "none":
+        wanted[:] = bytes(len(wanted))
+    elif action == "p":
+        selection["page"] = int(argument[0])
+    else:
+        rows = FileTree(files, selection).rows()
+        row = int(argument[0])
+        if row >= len(rows):
+            await callback.answer()
+            return
+        is_dir, path, _, start, end = rows[row][1]
+        if action == "t":
+            # Папка: если выбрано все - снимаем отметку со всего, иначе отмечаем все
+            value = 0 if wanted[start:end].count(1) == end - start else 1
+            wanted[start:end] = bytes([value]) * (end - start)
+        elif is_dir:
+            selection["expanded"].symmetric_difference_update({path})
+        else:
+            selection["priorities"][start] = NEXT_FILE_PRIORITY[selection["priorities"][start]]
+
+    sessions.set(user_id, "file_selection", selection)
+    text, keyboard = render_file_selection(files, selection)
+    await edit_message_if_changed(callback.message, text, reply_markup=keyboard, parse_mode="Markdown")
+    await callback.answer()
+
+# Разбор magnet-ссылок и архивов
+def get_magnet_label(magnet_link: str) -> str:
+    """Отображаемое имя magnet-ссылки (параметр dn или начало ссылки)"""
+    names = parse_qs(urlsplit(magnet_link).query).get("dn")
+    if names and names[0]:
+        return names[0]
+    return magnet_link[:60]
+
+def extract_torrents_from_zip(archive_data: bytes) -> list:
+    """Пары (имя, содержимое) .torrent файлов из zip-архива"""
+    items = []
+    unpacked_size = 0
+    with zipfile.ZipFile(io.BytesIO(archive_data)) as archive:
+        for info in archive.infolist():
+            if info.is_dir() or not info.filename.lower().endswith(".torrent"):
+                continue
+            if info.file_size > MAX_TORRENT_FILE_SIZE:
+                raise ValueError(f"{info.filename} больше {format_size(MAX_TORRENT_FILE_SIZE)}")
+            # zipfile не отдает больше заявленного размера, поэтому сумма file_size - честная граница
+            unpacked_size += info.file_size
+            if unpacked_size > MAX_ARCHIVE_UNPACKED_SIZE:
+                raise ValueError(f"В распакованном виде архив больше {format_size(MAX_ARCHIVE_UNPACKED_SIZE)}")
+            items.append((os.path.basename(info.filename), archive.read(info)))
+            if len(items) >= BULK_MAX_ITEMS:
+                break
+    return items
+
+async def download_document(document, max_size: int) -> bytes:
+    """Скачивание документа Telegram в память; размер проверяется до загрузки"""
+    if not document.file_size:
+        raise ValueError("размер файла неизвестен")
+    if document.file_size > max_size:
+        raise ValueError(f"файл больше {format_size(max_size)}")
+
+    buffer = io.BytesIO()
+    await bot.download(document, destination=buffer)
+
+    data = buffer.getvalue()
+    if not data:
+        raise ValueError("Файл пуст или не был загружен")
+    if len(data) > max_size:
+        raise ValueError(f"файл больше {format_size(max_size)}")
+    return data
+
+def clear_pending_uploads(user_id: int) -> None:
+    """Сброс ожидающих выбора категории ссылок и файлов пользователя"""
+    sessions.pop(user_id, "magnet")
+    pending_uploads.pop(user_id, "torrent_file")
+    pending_uploads.pop(user_id, "pick_files")
+    pending_uploads.pop(user_id, "bulk")
+    task = bulk_prompt_tasks.pop(user_id, None)
+    if task:
+        task.cancel()
+
+async def ask_bulk_category(message: Message, state: FSMContext, delay: float = 0) -> None:
+    """Запрос категории для накопленных торрентов (после паузы, чтобы дождаться всего альбома)"""
+    user_id = message.from_user.id
+    if delay:
+        await asyncio.sleep(delay)
+    if bulk_prompt_tasks.get(user_id) is asyncio.current_task():
+        del bulk_prompt_tasks[user_id]
+
+    bulk = pending_uploads.get(user_id, "bulk")
+    if not bulk or not bulk["items"]:
+        await message.answer("❌ В сообщении не найдено ни одного торрента.", reply_markup=get_main_keyboard())
+        return
+
+    await message.answer(
+        f"📦 *Получено торрентов: {len(bulk['items'])}*\n\n"
+        "📂 *Выберите категорию для загрузки:*",
+        reply_markup=get_category_keyboard(),
+        parse_mode="Markdown"
+    )
+    await state.set_state(TorrentStates.waiting_for_category)
+
+@dp.message(F.text.contains("magnet:?"))
 async def handle_magnet(message: Message, state: FSMContext):
-    """Обработка magnet-ссылок"""
+    """Обработка magnet-ссылок (одной или списка)"""
     if not check_access(message.from_user.id):
         return
 
-    cleanup_user_torrent_file(message.from_user.id)
-    magnet_link = message.text.strip()
-    user_magnets[message.from_user.id] = magnet_link
+    clear_pending_uploads(message.from_user.id)
+    magnet_links = list(dict.fromkeys(MAGNET_PATTERN.findall(message.text)))
+
+    if len(magnet_links) > 1:
+        items = [(get_magnet_label(link), link) for link in magnet_links[:BULK_MAX_ITEMS]]
+        pending_uploads.set(message.from_user.id, "bulk", {"group": None, "items": items})
+        await ask_bulk_category(message, state)
+        return
+
+    magnet_link = magnet_links[0] if magnet_links else message.text.strip()
+    sessions.set(message.from_user.id, "magnet", magnet_link, ttl=PENDING_UPLOAD_TTL)
 
     await message.answer(
         "📂 *Выберите категорию для загрузки:*",
@@ -614,50 +2690,137 @@ async def handle_magnet(message: Message, state: FSMContext):
 
 @dp.message(F.document)
 async def handle_torrent_file(message: Message, state: FSMContext):
-    """Обработка .torrent файлов"""
+    """Обработка .torrent файлов, альбомов из них и zip-архивов"""
     if not check_access(message.from_user.id):
         return
 
+    user_id = message.from_user.id
     document = message.document
     file_name = (document.file_name or "").lower()
+    is_archive = file_name.endswith(".zip")
 
-    if not file_name.endswith(".torrent"):
-        await message.answer("❌ Пожалуйста, отправьте файл с расширением .torrent.", reply_markup=get_main_keyboard())
+    if not file_name.endswith(".torrent") and not is_archive:
+        await message.answer(
+            "❌ Пожалуйста, отправьте файл с расширением .torrent или .zip архив с ними.",
+            reply_markup=get_main_keyboard()
+        )
         return
 
-    if message.from_user.id in user_magnets:
-        del user_magnets[message.from_user.id]
-    cleanup_user_torrent_file(message.from_user.id)
-
-    tmp_path = None
-    try:
-        with tempfile.NamedTemporaryFile(prefix="tmbot_", suffix=".torrent", delete=False) as tmp_file:
-            tmp_path = tmp_file.name
+    max_size = MAX_ARCHIVE_SIZE if is_archive else MAX_TORRENT_FILE_SIZE
+    if document.file_size and document.file_size > max_size:
+        await message.answer(
+            f"❌ Файл слишком большой: максимум {format_size(max_size)}.",
+            reply_markup=get_main_keyboard()
+        )
+        return
 
-        download = getattr(bot, "download", None)
-        if download:
-            await download(document, destination=tmp_path)
-        else:
-            file = await bot.get_file(document.file_id)
-            await bot.download_file(file.file_path, destination=tmp_path)
+    # Одиночный .torrent файл
+    if not is_archive and message.media_group_id is None:
+        clear_pending_uploads(user_id)
+        try:
+            torrent_data = await download_document(document, MAX_TORRENT_FILE_SIZE)
+            pending_uploads.set(user_id, "torrent_file", torrent_data)
 
-        if not os.path.exists(tmp_path) or os.path.getsize(tmp_path) == 0:
-            raise ValueError("Файл .torrent пуст или не был загружен")
+            await message.answer(
+                "📂 *Выберите категорию для загрузки:*",
+                reply_markup=get_category_keyboard(pick_files=False),
+                parse_mode="Markdown"
+            )
 
-        user_torrent_files[message.from_user.id] = tmp_path
+            await state.set_state(TorrentStates.waiting_for_category)
+        except Exception as e:
+            await message.answer(f"{EMOJI_ERROR} Ошибка при загрузке .torrent файла: {str(e)}", reply_markup=get_main_keyboard())
+            await state.clear()
+        return
 
+    # Альбом .torrent файлов или архив: копим элементы и спрашиваем категорию один раз
+    group = message.media_group_id or f"archive_{message.message_id}"
+    items = []
+    try:
+        data = await download_document(document, max_size)
+        if is_archive:
+            # Распаковка - CPU-работа, выполняем ее вне event loop
+            items = await asyncio.get_running_loop().run_in_executor(None, extract_torrents_from_zip, data)
+        else:
+            items = [(document.file_name, data)]
+    except Exception as e:
         await message.answer(
-            "📂 *Выберите категорию для загрузки:*",
-            reply_markup=get_category_keyboard(),
-            parse_mode="Markdown"
+            f"{EMOJI_ERROR} Ошибка при загрузке {escape_markdown(document.file_name)}: {str(e)}",
+            reply_markup=get_main_keyboard()
         )
 
-        await state.set_state(TorrentStates.waiting_for_category)
-    except Exception as e:
-        if tmp_path and os.path.exists(tmp_path):
-            os.remove(tmp_path)
-        await message.answer(f"{EMOJI_ERROR} Ошибка при загрузке .torrent файла: {str(e)}", reply_markup=get_main_keyboard())
-        await state.clear()
+    # Чтение и запись сессии без await между ними: файлы альбома обрабатываются параллельно
+    bulk = pending_uploads.get(user_id, "bulk")
+    if bulk is None or bulk["group"] != group:
+        clear_pending_uploads(user_id)
+        bulk = {"group": group, "items": []}
+    bulk["items"].extend(items[:BULK_MAX_ITEMS - len(bulk["items"])])
+    pending_uploads.set(user_id, "bulk", bulk)
+
+    previous_task = bulk_prompt_tasks.pop(user_id, None)
+    if previous_task:
+        previous_task.cancel()
+    delay = MEDIA_GROUP_DELAY if message.media_group_id else 0
+    bulk_prompt_tasks[user_id] = asyncio.create_task(ask_bulk_category(message, state, delay))
+
+@dp.callback_query(F.data == "pick_files")
+async def handle_pick_files_toggle(callback: CallbackQuery):
+    """Переключатель: добавить .torrent на паузе и сначала выбрать файлы"""
+    if not check_access(callback.from_user.id):
+        return
+
+    user_id = callback.from_user.id
+    if pending_uploads.get(user_id, "torrent_file") is None:
+        await callback.answer("❌ Файл не найден, отправьте его заново", show_alert=True)
+        return
+
+    pick_files = not pending_uploads.get(user_id, "pick_files", False)
+    pending_uploads.set(user_id, "pick_files", pick_files)
+    await callback.message.edit_reply_markup(reply_markup=get_category_keyboard(pick_files=pick_files))
+    await callback.answer()
+
+async def get_download_path(category: str) -> str:
+    """Каталог загрузки для категории"""
+    return f"{await get_download_dir(refresh=True)}/{category}"
+
+async def add_torrents_bulk(items, download_path: str):
+    """Параллельное добавление торрентов; возвращает (добавленные, дубликаты, ошибки)"""
+    await torrent_snapshot.ensure_fresh()
+    known_ids = set(torrent_snapshot.ids())
+    semaphore = asyncio.Semaphore(BULK_ADD_CONCURRENCY)
+
+    async def add_one(label, payload):
+        async with semaphore:
+            try:
+                return label, await rpc_call("add_torrent", payload, download_dir=download_path), None
+            except Exception as e:
+                return label, None, e
+
+    results = await asyncio.gather(*(add_one(label, payload) for label, payload in items))
+    torrent_snapshot.invalidate()
+    monitor_wakeup.set()
+
+    added, duplicates, failed = [], [], []
+    for label, torrent, error in results:
+        if error is not None:
+            failed.append((label, str(error)))
+        elif torrent.id in known_ids:
+            duplicates.append(torrent.name or label)
+        else:
+            known_ids.add(torrent.id)
+            added.append(torrent.name or label)
+    return added, duplicates, failed
+
+def build_bulk_report(category: str, added, duplicates, failed) -> list:
+    """Итоговый отчет массового добавления"""
+    header = (
+        f"📦 *Массовое добавление* ({get_category_emoji(category)} {category})\n"
+        f"✅ Добавлено: *{len(added)}* | ♻️ Уже были: *{len(duplicates)}* | ❌ Ошибки: *{len(failed)}*\n\n"
+    )
+    lines = [f"✅ {escape_markdown(name)}\n" for name in added]
+    lines += [f"♻️ {escape_markdown(name)}\n" for name in duplicates]
+    lines += [f"❌ {escape_markdown(label)}: {escape_markdown(error)}\n" for label, error in failed]
+    return split_message(header, lines)
 
 @dp.callback_query(F.data.startswith("category_"))
 async def handle_category_selection(callback: CallbackQuery, state: FSMContext):
@@ -666,40 +2829,48 @@ async def handle_category_selection(callback: CallbackQuery, state: FSMContext):
         await callback.answer("⛔ У вас нет доступа")
         return
 
+    bulk = pending_uploads.pop(callback.from_user.id, "bulk")
+    if bulk and bulk["items"]:
+        await handle_bulk_category_selection(callback, bulk["items"])
+        await state.clear()
+        return
+
     magnet_link = None
-    torrent_file = None
+    torrent_data = None
     try:
         category = callback.data.replace("category_", "")
-        magnet_link = user_magnets.get(callback.from_user.id)
-        torrent_file = user_torrent_files.get(callback.from_user.id)
+        magnet_link = sessions.get(callback.from_user.id, "magnet")
+        torrent_data = pending_uploads.get(callback.from_user.id, "torrent_file")
 
-        if not magnet_link and not torrent_file:
+        if not magnet_link and not torrent_data:
             await callback.answer("❌ Ошибка: файл или ссылка не найдены")
             await callback.message.edit_text("❌ Ошибка: попробуйте отправить magnet-ссылку или .torrent файл заново")
             await state.clear()
             return
 
-        session = client.get_session()
-        base_download_dir = session.download_dir
-        download_path = f"{base_download_dir}/{category}"
+        download_path = await get_download_path(category)
+        pick_files = False
+        duplicate = False
 
         if magnet_link:
-            torrent = client.add_torrent(magnet_link, download_dir=download_path)
-            del user_magnets[callback.from_user.id]
+            torrent = await rpc_call("add_torrent", magnet_link, download_dir=download_path)
+            torrent_snapshot.invalidate()
+            monitor_wakeup.set()
+            sessions.pop(callback.from_user.id, "magnet")
         else:
-            with open(torrent_file, "rb") as f:
-                torrent_data = f.read()
-            if not torrent_data:
-                raise ValueError("Файл .torrent пуст")
-            torrent = client.add_torrent(torrent_data, download_dir=download_path)
-            cleanup_user_torrent_file(callback.from_user.id)
-
-        emoji = {
-            "Movies": "🎬",
-            "Series": "📺",
-            "Music": "🎵",
-            "Other": "📁"
-        }.get(category, "📂")
+            # Список файлов .torrent известен сразу: при выборе файлов торрент ждет на паузе
+            pick_files = pending_uploads.pop(callback.from_user.id, "pick_files", False)
+            await torrent_snapshot.ensure_fresh()
+            known_ids = set(torrent_snapshot.ids())
+            torrent = await rpc_call("add_torrent", torrent_data, download_dir=download_path, paused=pick_files)
+            torrent_snapshot.invalidate()
+            monitor_wakeup.set()
+            pending_uploads.pop(callback.from_user.id, "torrent_file")
+            # Для дубликата Transmission возвращает уже добавленный торрент и не ставит его на паузу
+            duplicate = torrent.id in known_ids
+            pick_files = pick_files and not duplicate
+
+        emoji = get_category_emoji(category)
 
         success_message = (
             f"{EMOJI_COMPLETED} *Торрент добавлен!*\n\n"
@@ -708,129 +2879,739 @@ async def handle_category_selection(callback: CallbackQuery, state: FSMContext):
             f"📊 ID: `{torrent.id}`\n"
             f"📁 Папка: `{download_path}`"
         )
-
-        await callback.message.edit_text(success_message, parse_mode="Markdown")
+        if duplicate:
+            success_message += "\n\nℹ️ Этот торрент уже был добавлен ранее"
+        elif pick_files:
+            success_message += "\n\n⏸️ Торрент на паузе: загрузка начнется после выбора файлов"
+
+        track_keyboard = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="📂 Выбрать файлы", callback_data=f"files_{torrent.id}")],
+            [InlineKeyboardButton(text="📡 Следить за загрузкой", callback_data=f"track_{torrent.id}")]
+        ])
+
+        await callback.message.edit_text(success_message, reply_markup=track_keyboard, parse_mode="Markdown")
+        if pick_files:
+            await start_file_selection(callback.message, callback.from_user.id, torrent.id)
         await callback.message.answer("Что дальше?", reply_markup=get_main_keyboard())
         await callback.answer("✅ Торрент добавлен!")
 
     except Exception as e:
-        if torrent_file:
-            cleanup_user_torrent_file(callback.from_user.id)
+        if torrent_data:
+            pending_uploads.pop(callback.from_user.id, "torrent_file")
         await callback.message.edit_text(f"{EMOJI_ERROR} Ошибка при добавлении торрента: {str(e)}")
         await callback.answer("❌ Ошибка")
 
     await state.clear()
 
+async def start_file_selection(message: Message, user_id: int, torrent_id: int) -> None:
+    """Выбор файлов только что добавленного на паузе торрента; при сбое торрент запускается целиком"""
+    try:
+        if await open_file_selection(message, user_id, torrent_id, start_on_finish=True):
+            return
+        error = "список файлов не получен"
+    except Exception as e:
+        error = str(e)
+
+    print(f"Не удалось открыть выбор файлов торрента {torrent_id}: {error}")
+    try:
+        await rpc_call("start_torrent", torrent_id)
+        torrent_snapshot.invalidate()
+        monitor_wakeup.set()
+        await message.answer("⚠️ Не удалось открыть выбор файлов, торрент запущен целиком")
+    except Exception as e:
+        print(f"Ошибка запуска торрента {torrent_id}: {e}")
+        await message.answer(
+            "⚠️ Не удалось открыть выбор файлов, торрент остался на паузе",
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="▶️ Запустить", callback_data=f"card_start_{torrent_id}")]
+            ])
+        )
+
+async def handle_bulk_category_selection(callback: CallbackQuery, items) -> None:
+    """Добавление накопленных торрентов в выбранную категорию с итоговым отчетом"""
+    category = callback.data.replace("category_", "")
+    try:
+        await callback.answer(f"⏳ Добавляю {len(items)}...")
+        await callback.message.edit_text(f"⏳ Добавляю торренты: *{len(items)}*...", parse_mode="Markdown")
+
+        download_path = await get_download_path(category)
+        added, duplicates, failed = await add_torrents_bulk(items, download_path)
+        report = build_bulk_report(category, added, duplicates, failed)
+
+        await callback.message.edit_text(report[0], parse_mode="Markdown")
+        for text in report[1:]:
+            await callback.message.answer(text, parse_mode="Markdown")
+        await callback.message.answer("Что дальше?", reply_markup=get_main_keyboard())
+    except Exception as e:
+        await callback.message.edit_text(f"{EMOJI_ERROR} Ошибка при добавлении торрентов: {str(e)}")
+
 @dp.callback_query(F.data == "cancel")
 async def handle_cancel(callback: CallbackQuery, state: FSMContext):
     """Обработка отмены"""
     if not check_access(callback.from_user.id):
         return
 
-    if callback.from_user.id in user_magnets:
-        del user_magnets[callback.from_user.id]
-    cleanup_user_torrent_file(callback.from_user.id)
+    clear_pending_uploads(callback.from_user.id)
+    sessions.pop(callback.from_user.id, "delete_selection")
 
     await callback.message.edit_text("❌ Отменено")
     await callback.message.answer("Отправьте новую magnet-ссылку или .torrent файл", reply_markup=get_main_keyboard())
     await callback.answer("Отменено")
     await state.clear()
 
-async def check_completed_torrents():
-    """Проверка завершенных торрентов и отправка уведомлений"""
-    completed_cache = set()
-    initialized = False
+# Рассылка уведомлений с учетом лимитов Telegram
+class TokenBucket:
+    """Ограничитель частоты: rate токенов в секунду, запас не больше capacity"""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    async def acquire(self) -> None:
+        """Ожидание свободного токена"""
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class Notifier:
+    """Отправка сообщений: общий и поштучный по чатам лимит, повтор после RetryAfter"""
+
+    def __init__(self, global_rate: float, chat_rate: float):
+        self.chat_rate = chat_rate
+        self.global_bucket = TokenBucket(global_rate)
+        self.chat_buckets = {}
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate)
+        return bucket
+
+    async def send(self, chat_id: int, text: str, **kwargs) -> bool:
+        """Отправка одного сообщения; False, если доставить не удалось"""
+        bucket = self._chat_bucket(chat_id)
+
+        for attempt in range(TELEGRAM_SEND_ATTEMPTS):
+            await bucket.acquire()
+            await self.global_bucket.acquire()
+            try:
+                await bot.send_message(chat_id, text, **kwargs)
+                return True
+            except TelegramRetryAfter as e:
+                telegram_flood_waits.inc()
+                print(f"⏳ Flood control для {chat_id}: повтор через {e.retry_after} сек")
+                await asyncio.sleep(e.retry_after)
+            except Exception as e:
+                telegram_send_failures.inc()
+                print(f"Ошибка отправки сообщения пользователю {chat_id}: {e}")
+                return False
+
+        telegram_send_failures.inc()
+        print(f"Сообщение пользователю {chat_id} не отправлено после {TELEGRAM_SEND_ATTEMPTS} попыток")
+        return False
 
-    while True:
+    async def edit(self, chat_id: int, message_id: int, text: str, **kwargs) -> bool:
+        """Редактирование сообщения с теми же лимитами; False, если сообщения больше нельзя изменить"""
+        bucket = self._chat_bucket(chat_id)
+
+        for attempt in range(TELEGRAM_SEND_ATTEMPTS):
+            await bucket.acquire()
+            await self.global_bucket.acquire()
+            try:
+                await bot.edit_message_text(text, chat_id=chat_id, message_id=message_id, **kwargs)
+                return True
+            except TelegramRetryAfter as e:
+                telegram_flood_waits.inc()
+                await asyncio.sleep(e.retry_after)
+            except TelegramBadRequest as e:
+                if "message is not modified" in str(e):
+                    return True
+                print(f"Сообщение {message_id} в чате {chat_id} больше не редактируется: {e}")
+                return False
+            except Exception as e:
+                telegram_send_failures.inc()
+                print(f"Ошибка редактирования сообщения {message_id} в чате {chat_id}: {e}")
+                return True
+
+        telegram_send_failures.inc()
+        return True
+
+    async def send_many(self, chat_id: int, texts, **kwargs) -> None:
+        """Последовательная отправка нескольких сообщений в один чат"""
+        for text in texts:
+            await self.send(chat_id, text, **kwargs)
+
+    async def broadcast(self, chat_ids, texts, **kwargs) -> None:
+        """Параллельная рассылка сообщений по чатам"""
+        await asyncio.gather(*(self.send_many(chat_id, texts, **kwargs) for chat_id in chat_ids))
+
+notifier = Notifier(TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE)
+
+# Живой прогресс загрузок
+def format_eta(seconds: int) -> str:
+    """Оставшееся время: "1 ч 5 мин", "12 мин", "40 сек" или "—", если неизвестно"""
+    if seconds < 0:
+        return "—"
+    hours, minutes = divmod(seconds // 60, 60)
+    if hours:
+        return f"{hours} ч {minutes} мин"
+    if minutes:
+        return f"{minutes} мин"
+    return f"{seconds} сек"
+
+def format_progress_bar(progress: float, width: int = 10) -> str:
+    filled = min(width, int(progress / 100 * width))
+    return "▓" * filled + "░" * (width - filled)
+
+def render_tracking_message(torrent):
+    """Текст живого прогресса, клавиатура и признак завершения отслеживания"""
+    if torrent is None:
+        return "🗑 *Торрент удален* - отслеживание остановлено", None, True
+
+    name = escape_markdown(torrent.name)
+    if torrent.progress >= 100:
+        return (
+            f"{EMOJI_COMPLETED} *Загрузка завершена!*\n\n"
+            f"📝 `{name}`\n"
+            f"📦 Размер: *{format_size(torrent.total_size)}*"
+        ), None, True
+
+    text = (
+        f"📡 *Прогресс загрузки*\n\n"
+        f"{get_status_emoji(torrent.status)} `{name}`\n"
+        f"📊 {format_progress_bar(torrent.progress)} *{torrent.progress:.1f}%*\n"
+        f"⬇️ Скорость: *{format_size(torrent.rate_download)}/s*\n"
+        f"⏱ Осталось: *{format_eta(torrent.eta)}*"
+    )
+    if torrent.error_string:
+        text += f"\n⚠️ Ошибка: {escape_markdown(torrent.error_string)}"
+
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text="⏹ Не следить", callback_data=f"untrack_{torrent.id}")
+    ]])
+    return text, keyboard, False
+
+class ProgressTracker:
+    """Сообщения с живым прогрессом; обновляются из общего снимка после опроса мониторинга"""
+
+    def __init__(self, notifier: Notifier, limit: int):
+        self.notifier = notifier
+        self.limit = limit
+        # (chat_id, message_id) -> [id торрента, число опросов подряд без него в снимке]
+        self._tracked = {}
+        # Последний показанный текст и ожидающие отправки правки
+        self._shown = {}
+        self._pending = {}
+        self._flush_task = None
+
+    def __bool__(self) -> bool:
+        return bool(self._tracked)
+
+    def track(self, chat_id: int, message_id: int, torrent_id: int) -> bool:
+        key = (chat_id, message_id)
+        if key not in self._tracked and len(self._tracked) >= self.limit:
+            return False
+        self._tracked[key] = [torrent_id, 0]
+        return True
+
+    def untrack(self, chat_id: int, message_id: int) -> None:
+        key = (chat_id, message_id)
+        self._tracked.pop(key, None)
+        self._shown.pop(key, None)
+        self._pending.pop(key, None)
+
+    def shown(self, chat_id: int, message_id: int, text: str, finished: bool = False) -> None:
+        """Отметка текста, уже показанного в сообщении"""
+        if finished:
+            self.untrack(chat_id, message_id)
+        else:
+            self._shown[(chat_id, message_id)] = text
+
+    def refresh(self, snapshot) -> None:
+        """Перерисовка всех отслеживаемых сообщений; правки только там, где текст изменился"""
+        for key, entry in list(self._tracked.items()):
+            torrent = snapshot.get_torrent(entry[0])
+            # Только что добавленный торрент может еще не попасть в снимок
+            if torrent is None:
+                entry[1] += 1
+                if entry[1] < 2:
+                    continue
+            else:
+                entry[1] = 0
+
+            text, keyboard, finished = render_tracking_message(torrent)
+            if finished:
+                del self._tracked[key]
+            if text != self._shown.get(key):
+                # Несколько обновлений до отправки сливаются в одну правку с последним текстом
+                self._pending[key] = (text, keyboard)
+            elif finished:
+                self._shown.pop(key, None)
+
+        if self._pending and self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush())
+
+    async def _flush(self) -> None:
         try:
-            torrents = client.get_torrents()
+            while self._pending:
+                key = next(iter(self._pending))
+                text, keyboard = self._pending.pop(key)
+                alive = await self.notifier.edit(*key, text, reply_markup=keyboard, parse_mode="Markdown")
+                if alive and key in self._tracked:
+                    self._shown[key] = text
+                else:
+                    self.untrack(*key)
+        finally:
+            self._flush_task = None
+
+progress_tracker = ProgressTracker(notifier, TRACK_MAX_MESSAGES)
+
+def build_completion_messages(torrents) -> list:
+    """Уведомления о завершенных загрузках: одно на торрент или сводка, разбитая по лимиту длины"""
+    if len(torrents) == 1:
+        torrent = torrents[0]
+        return [
+            f"{EMOJI_COMPLETED} *Загрузка завершена!*\n\n"
+            f"📝 {escape_markdown(torrent.name)}\n"
+            f"📦 Размер: *{format_size(torrent.total_size)}*"
+        ]
+
+    return split_message(
+        f"{EMOJI_COMPLETED} *Завершено загрузок: {len(torrents)}*\n\n",
+        (f"📝 {escape_markdown(t.name)} — *{format_size(t.total_size)}*\n" for t in torrents)
+    )
+
+# Постоянное состояние мониторинга
+class CompletionStore:
+    """Последний увиденный прогресс торрентов по info-hash, чтобы переживать перезапуски"""
 
-            if not initialized:
-                completed_cache = {t.id for t in torrents if t.progress == 100}
-                initialized = True
+    def __init__(self, db):
+        self.db = db
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS torrent_progress ("
+            "hash TEXT PRIMARY KEY, progress REAL NOT NULL)"
+        )
+        self.db.commit()
+
+    def load(self) -> dict:
+        """Все сохраненные значения: info-hash -> прогресс"""
+        return dict(self.db.execute("SELECT hash, progress FROM torrent_progress"))
+
+    def save(self, progress_by_hash: dict) -> None:
+        """Пакетная запись изменившегося прогресса одной транзакцией"""
+        if not progress_by_hash:
+            return
+        with self.db:
+            self.db.executemany(
+                "INSERT INTO torrent_progress (hash, progress) VALUES (?, ?) "
+                "ON CONFLICT(hash) DO UPDATE SET progress = excluded.progress",
+                progress_by_hash.items()
+            )
+
+    def remove(self, hashes) -> None:
+        """Удаление записей о торрентах, которых больше нет в Transmission"""
+        if not hashes:
+            return
+        with self.db:
+            self.db.executemany("DELETE FROM torrent_progress WHERE hash = ?", ((h,) for h in hashes))
+
+completion_store = CompletionStore(state_db)
+
+class CompletionMonitor:
+    """Отслеживание завершения загрузок между опросами Transmission"""
+
+    def __init__(self, store: CompletionStore):
+        self.store = store
+        # Пустое хранилище - первый запуск: уже завершенные торренты не объявляем
+        self.progress_by_hash = store.load()
+        self.first_run = not self.progress_by_hash
+        self.initialized = False
+        self.last_full_sync = 0.0
+        self.last_poll = 0.0
+
+    async def poll(self) -> list:
+        """Один опрос: обновление снимка и сохраненного прогресса; возвращает завершенные торренты"""
+        now = time.monotonic()
+        full_sync = (
+            not self.initialized
+            or now - self.last_full_sync >= FULL_SYNC_INTERVAL
+            or now - self.last_poll >= RECENTLY_ACTIVE_WINDOW
+        )
+
+        # Полная синхронизация при старте и периодически, между ними - только изменения
+        started = time.monotonic()
+        if full_sync:
+            changed = await torrent_snapshot.refresh()
+            current_hashes = {t.hash_string for t in changed}
+            removed_hashes = [h for h in self.progress_by_hash if h not in current_hashes]
+            for torrent_hash in removed_hashes:
+                del self.progress_by_hash[torrent_hash]
+            self.store.remove(removed_hashes)
+            self.last_full_sync = now
+        else:
+            changed, _ = await torrent_snapshot.refresh_delta()
+        self.last_poll = now
+        poll_duration.observe(time.monotonic() - started, "full" if full_sync else "delta")
+
+        completed = []
+        updates = {}
+        for torrent in changed:
+            progress = torrent.progress
+            previous = self.progress_by_hash.get(torrent.hash_string)
+            if previous == progress:
+                continue
+            self.progress_by_hash[torrent.hash_string] = progress
+            updates[torrent.hash_string] = progress
+            if progress == 100 and (self.initialized or not self.first_run):
+                completed.append(torrent)
+
+        self.store.save(updates)
+        self.initialized = True
+        return completed
+
+class PollScheduler:
+    """Интервал до следующего опроса: короче при близком ETA, экспоненциально дольше без загрузок"""
+
+    def __init__(self, base: float, minimum: float, maximum: float):
+        self.base = base
+        self.minimum = minimum
+        # Дольше окна recently-active каждый опрос стал бы полной синхронизацией всей библиотеки
+        self.maximum = max(base, min(maximum, RECENTLY_ACTIVE_WINDOW - RECENTLY_ACTIVE_MARGIN))
+        self.idle_interval = base
+
+    def next_interval(self, downloading, tracking: bool = False) -> float:
+        interval = self._interval(downloading)
+        # Пока кто-то смотрит на живой прогресс, опрашиваем не реже TRACK_INTERVAL
+        return min(interval, max(self.minimum, TRACK_INTERVAL)) if tracking else interval
+
+    def _interval(self, downloading) -> float:
+        if not downloading:
+            interval = self.idle_interval
+            self.idle_interval = min(self.idle_interval * 2, self.maximum)
+            return interval
+
+        self.idle_interval = self.base
+        etas = [t.eta for t in downloading if t.eta >= 0]
+        if not etas:
+            return self.base
+        # Опрос сразу после ожидаемого завершения ближайшей загрузки
+        return min(self.base, max(self.minimum, min(etas) + 1))
+
+# Планировщик загрузок по категориям
+class DownloadScheduler:
+    """Лимиты одновременных загрузок по категориям: лишние торренты ставятся на паузу и запускаются по очереди"""
+
+    def __init__(self, db, limits: dict, priority: list, max_active: int):
+        self.db = db
+        self.limits = limits
+        self.max_active = max_active
+        self.rank = {category: i for i, category in enumerate(priority)}
+        self.categories = {category.strip() for category in DOWNLOAD_CATEGORIES} | set(priority) | set(limits)
+        # Категория -> (загружается, в очереди) на момент последнего опроса
+        self.summary = {}
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS scheduler_paused ("
+            "hash TEXT PRIMARY KEY, id INTEGER NOT NULL)"
+        )
+        self.db.commit()
+        # Остановленные планировщиком торренты: info-hash -> ID (ID меняются после перезапуска демона)
+        self.paused = dict(self.db.execute("SELECT hash, id FROM scheduler_paused"))
+
+    def get_category(self, torrent):
+        """Категория по каталогу загрузки {download_dir}/{category} или None"""
+        category = os.path.basename(torrent.download_dir.rstrip("/"))
+        return category if category in self.categories else None
+
+    def _paused_torrents(self, snapshot) -> list:
+        """Торренты, которые остановил планировщик и которые все еще стоят"""
+        torrents = {}
+        missing = []
+        for torrent_hash, torrent_id in self.paused.items():
+            torrent = snapshot.get_torrent(torrent_id)
+            if torrent is not None and torrent.hash_string == torrent_hash:
+                torrents[torrent_hash] = torrent
+            else:
+                missing.append(torrent_hash)
+        if missing:
+            # ID сменились (перезапуск Transmission) - ищем по info-hash одним проходом
+            wanted = set(missing)
+            for torrent in snapshot.torrents:
+                if torrent.hash_string in wanted:
+                    torrents[torrent.hash_string] = torrent
+        # Запущенные вручную, завершенные и удаленные больше не считаются поставленными на паузу
+        return [t for t in torrents.values() if t.status == "stopped" and t.percent_done < 1]
+
+    def plan(self, torrents) -> tuple:
+        """Разбиение на (запускаемые, останавливаемые, приоритет полосы по ID) для загрузок в порядке очереди"""
+        queue = []
+        for torrent in torrents:
+            category = self.get_category(torrent)
+            if category is not None:
+                queue.append((self.rank.get(category, len(self.rank)), torrent.added_date, torrent.id, category, torrent))
+        queue.sort(key=lambda item: item[:3])
+
+        running = {}
+        queued = {}
+        total = 0
+        to_start = []
+        to_stop = []
+        allowed = []
+        for _, _, _, category, torrent in queue:
+            limit = self.limits.get(category)
+            if (limit is None or running.get(category, 0) < limit) and (not self.max_active or total < self.max_active):
+                running[category] = running.get(category, 0) + 1
+                total += 1
+                allowed.append((category, torrent))
+                if torrent.status == "stopped":
+                    to_start.append(torrent)
+            else:
+                queued[category] = queued.get(category, 0) + 1
+                if torrent.status != "stopped":
+                    to_stop.append(torrent)
+
+        # Высокий приоритет полосы - самой важной из загружающихся категорий, низкий - наименее важной
+        ranks = sorted({self.rank.get(category, len(self.rank)) for category in running})
+        bandwidth = {}
+        for category, torrent in allowed:
+            rank = self.rank.get(category, len(self.rank))
+            if len(ranks) == 1:
+                bandwidth[torrent.id] = 0
+            elif rank == ranks[0]:
+                bandwidth[torrent.id] = 1
+            elif rank == ranks[-1]:
+                bandwidth[torrent.id] = -1
             else:
-                for torrent in torrents:
-                    if torrent.progress == 100 and torrent.id not in completed_cache:
-                        completed_cache.add(torrent.id)
-
-                        completion_message = (
-                            f"{EMOJI_COMPLETED} *Загрузка завершена!*\n\n"
-                            f"📝 {torrent.name}\n"
-                            f"📦 Размер: *{format_size(torrent.total_size)}*"
-                        )
-
-                        for user_id in ALLOWED_USER_IDS:
-                            try:
-                                await bot.send_message(
-                                    user_id,
-                                    completion_message,
-                                    parse_mode="Markdown",
-                                    reply_markup=get_main_keyboard()
-                                )
-                            except Exception as e:
-                                print(f"Ошибка отправки уведомления пользователю {user_id}: {e}")
+                bandwidth[torrent.id] = 0
+
+        self.summary = {
+            category: (running.get(category, 0), queued.get(category, 0))
+            for category in sorted(set(running) | set(queued), key=lambda c: self.rank.get(c, len(self.rank)))
+        }
+        return to_start, to_stop, bandwidth
+
+    async def apply(self, snapshot) -> None:
+        """Приведение загрузок в соответствие с лимитами: запуск, остановка и приоритет полосы"""
+        paused = self._paused_torrents(snapshot)
+        candidates = {t.id: t for t in snapshot.get_downloading()}
+        candidates.update((t.id, t) for t in paused)
+        to_start, to_stop, bandwidth = self.plan(candidates.values())
+
+        changes = {}
+        for torrent_id, priority in bandwidth.items():
+            if candidates[torrent_id].bandwidth_priority != priority:
+                changes.setdefault(priority, []).append(torrent_id)
+
+        if to_stop:
+            await rpc_call("stop_torrent", [t.id for t in to_stop])
+        if to_start:
+            await rpc_call("start_torrent", [t.id for t in to_start])
+        for priority, ids in changes.items():
+            await rpc_call("change_torrent", ids, bandwidth_priority=priority)
+
+        started = {t.hash_string for t in to_start}
+        paused_now = {t.hash_string: t.id for t in paused if t.hash_string not in started}
+        paused_now.update((t.hash_string, t.id) for t in to_stop)
+        if paused_now != self.paused:
+            with self.db:
+                self.db.execute("DELETE FROM scheduler_paused")
+                self.db.executemany("INSERT INTO scheduler_paused (hash, id) VALUES (?, ?)", paused_now.items())
+            self.paused = paused_now
+
+        changed_ids = {t.id for t in to_start} | {t.id for t in to_stop}
+        changed_ids.update(torrent_id for ids in changes.values() for torrent_id in ids)
+        if changed_ids:
+            if to_start or to_stop:
+                print(f"🚦 Планировщик: запущено {len(to_start)}, поставлено в очередь {len(to_stop)}")
+            # Статусы в снимке обновляем сразу, не дожидаясь следующего опроса
+            snapshot.merge(await rpc_call("get_torrents", sorted(changed_ids), arguments=SNAPSHOT_FIELDS, convert=to_records))
+
+    def format_status(self) -> str:
+        """Блок очереди загрузок для статуса"""
+        if not self.summary:
+            return ""
+        lines = ["🚦 *Очередь загрузок:*"]
+        for category, (running, queued) in self.summary.items():
+            limit = self.limits.get(category)
+            line = f"• {escape_markdown(category)}: ⬇️ {running}/{limit if limit is not None else '∞'}"
+            if queued:
+                line += f", ⏳ в очереди {queued}"
+            lines.append(line)
+        if self.max_active:
+            total = sum(running for running, _ in self.summary.values())
+            lines.append(f"Всего загружается: {total}/{self.max_active}")
+        return "\n".join(lines)
+
+download_scheduler = DownloadScheduler(state_db, CATEGORY_LIMITS, CATEGORY_PRIORITY, MAX_ACTIVE_DOWNLOADS)
+
+# Будит мониторинг раньше срока (торрент добавлен или запущен из бота)
+monitor_wakeup = asyncio.Event()
 
+async def check_completed_torrents():
+    """Проверка завершенных торрентов и отправка уведомлений"""
+    monitor = CompletionMonitor(completion_store)
+    scheduler = PollScheduler(CHECK_INTERVAL, MIN_CHECK_INTERVAL, MAX_CHECK_INTERVAL)
+    if scheduler.maximum < MAX_CHECK_INTERVAL:
+        print(f"⚠️ MAX_CHECK_INTERVAL ограничен {scheduler.maximum:g} сек: реже опросы были бы полной синхронизацией")
+
+    while True:
+        try:
+            completed = await monitor.poll()
+            progress_tracker.refresh(torrent_snapshot)
+
+            # Все завершения за один опрос уходят одной сводкой каждому пользователю
+            if completed:
+                await notifier.broadcast(
+                    ALLOWED_USER_IDS,
+                    build_completion_messages(completed),
+                    parse_mode="Markdown",
+                    reply_markup=get_main_keyboard()
+                )
+
+            # После уведомлений: ошибка планировщика не должна терять сводку о завершениях
+            if DOWNLOAD_SCHEDULER_ENABLED:
+                await download_scheduler.apply(torrent_snapshot)
         except Exception as e:
             print(f"Ошибка проверки торрентов: {e}")
 
-        await asyncio.sleep(CHECK_INTERVAL)
+        # Отдельно от опроса: сбой планировщика не должен оставлять пропуски в истории
+        try:
+            await record_activity()
+        except Exception as e:
+            print(f"Ошибка записи истории: {e}")
+
+        interval = scheduler.next_interval(torrent_snapshot.get_downloading(), tracking=bool(progress_tracker))
+        try:
+            await asyncio.wait_for(monitor_wakeup.wait(), interval)
+        except asyncio.TimeoutError:
+            pass
+        monitor_wakeup.clear()
 
 async def wait_for_rpc():
     """Ожидание доступности Transmission RPC"""
     attempt = 0
     while True:
         try:
-            client.get_session()
+            await get_download_dir(refresh=True)
             print("✅ Transmission RPC доступен")
             return
         except Exception as e:
             attempt += 1
             if attempt == 1 or attempt % 5 == 0:
                 print(f"⏳ Ожидание Transmission RPC (попытка {attempt}): {e}")
-            await asyncio.sleep(2)
+            await asyncio.sleep(get_retry_delay(min(attempt, 6)))
+
+async def run_webhook():
+    """Прием обновлений через webhook (aiohttp) вместо long polling"""
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=WEBHOOK_SECRET or None
+    ).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+
+    # Без WEBHOOK_URL webhook в Telegram не регистрируется - удобно для локальной отправки записанных обновлений
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET or None
+        )
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+    print(f"🌐 Webhook: http://{WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+    # docker stop шлет SIGTERM: выходим штатно, чтобы сработали хуки завершения и сохранение состояния
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+
+    try:
+        await stop.wait()
+        print("🛑 Остановка webhook-сервера...")
+    finally:
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.remove_signal_handler(sig)
+            except NotImplementedError:
+                pass
+        await runner.cleanup()
+
+async def handle_metrics(request):
+    """GET /metrics для Prometheus"""
+    return web.Response(
+        body=render_metrics().encode(),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+    )
+
+async def start_metrics_server():
+    """Отдельный HTTP-сервер с эндпоинтом /metrics"""
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    print(f"📈 Метрики: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return runner
 
 async def main():
     """Главная функция запуска бота"""
     print(f"🚀 Запуск Transmission Master Bot...")
     print(f"📡 Transmission: {TRANSMISSION_HOST}:{TRANSMISSION_PORT}")
-    print(f"⏰ Интервал проверки: {CHECK_INTERVAL} сек")
+    print(f"⏰ Интервал проверки: {MIN_CHECK_INTERVAL}-{CHECK_INTERVAL} сек, без загрузок до {MAX_CHECK_INTERVAL} сек")
+    if CHECK_INTERVAL >= RECENTLY_ACTIVE_WINDOW:
+        print(f"⚠️ CHECK_INTERVAL >= {RECENTLY_ACTIVE_WINDOW} сек: каждая проверка будет полной синхронизацией")
     print(f"👥 Разрешенные пользователи: {ALLOWED_USER_IDS}")
     print(f"📂 Категории загрузок: {DOWNLOAD_CATEGORIES}")
+    print(f"📨 Режим обновлений: {BOT_MODE}")
 
     await wait_for_rpc()
 
     if ALLOWED_USER_IDS:
         try:
-            torrents = client.get_torrents()
-            active, seeding, paused, errors, total = get_status_counts(torrents)
+            stats, counts = await get_status_data()
 
             startup_message = (
                 "✅ *Transmission Master Bot запущен*\n\n"
-                f"🔄 Загружается: *{active}*\n"
-                f"✅ Раздается: *{seeding}*\n"
-                f"⏸️ Остановлено: *{paused}*\n"
+                f"{format_status_counts(stats, counts)}"
             )
 
-            if errors > 0:
-                startup_message += f"❌ С ошибками: *{errors}*\n"
-
-            startup_message += f"📦 Всего: *{total}*"
-
-            for user_id in ALLOWED_USER_IDS:
-                try:
-                    await bot.send_message(
-                        user_id,
-                        startup_message,
-                        parse_mode="Markdown",
-                        reply_markup=get_main_keyboard()
-                    )
-                except Exception as e:
-                    print(f"Ошибка отправки старта пользователю {user_id}: {e}")
+            await notifier.broadcast(
+                ALLOWED_USER_IDS,
+                [startup_message],
+                parse_mode="Markdown",
+                reply_markup=get_main_keyboard()
+            )
         except Exception as e:
             print(f"Ошибка отправки статуса при старте: {e}")
 
     asyncio.create_task(check_completed_torrents())
-    await dp.start_polling(bot)
+
+    metrics_runner = await start_metrics_server() if METRICS_PORT else None
+
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook()
+        else:
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
+    finally:
+        activity_history.save()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
 
 if __name__ == "__main__":
     asyncio.run(main())